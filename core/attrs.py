@@ -0,0 +1,129 @@
+import os, json
+import numpy as np
+
+# per-row columns, aligned with the store's ids (row i of each array == ids[i]): the
+# filter codes plus everything a search result needs, so responses never touch the DB
+COLUMNS = ("root", "folder", "orientation", "width", "height", "path_off", "path_blob")
+ATTR_FILES = tuple(f"attr_{c}.npy" for c in COLUMNS) + ("attrs.json",)
+ORIENTATIONS = ("landscape", "portrait", "square")
+_ORI_CODE = {o: i for i, o in enumerate(ORIENTATIONS)}
+
+class Attrs:
+    """Compact code arrays + string dictionaries for root/top_folder/orientation, sizes and paths."""
+    def __init__(self, root, folder, orientation, width, height, path_off, path_blob, roots, folders):
+        self.root = root                # int16 codes into self.roots (-1 = unknown)
+        self.folder = folder            # int32 codes into self.folders
+        self.orientation = orientation  # int8 codes into ORIENTATIONS
+        self.width = width              # int32 (-1 = unknown)
+        self.height = height
+        self.path_off = path_off        # int64 [n + 1]: row i's path is path_blob[off[i]:off[i+1]]
+        self.path_blob = path_blob      # uint8 UTF-8 bytes of every row's path
+        self.roots = list(roots)
+        self.folders = list(folders)
+        self._root_code = {r: i for i, r in enumerate(self.roots)}
+        self._folder_code = {f: i for i, f in enumerate(self.folders)}
+
+    def __len__(self):
+        return int(self.root.shape[0])
+
+    def paths(self, rows):
+        off, blob = self.path_off, self.path_blob
+        return [bytes(blob[off[r]:off[r + 1]]).decode("utf-8") for r in rows]
+
+    def items(self, rows, ids, scores):
+        """Search result dicts for matrix `rows` (images.id `ids`), gathered column-wise."""
+        rows = np.asarray(rows, dtype=np.int64)
+        w, h = self.width[rows].tolist(), self.height[rows].tolist()
+        ori, folder = self.orientation[rows].tolist(), self.folder[rows].tolist()
+        return [{
+            "path": p, "id": int(i), "score": float(s),
+            "width": None if w[k] < 0 else w[k], "height": None if h[k] < 0 else h[k],
+            "orientation": ORIENTATIONS[ori[k]] if ori[k] >= 0 else None,
+            "folder": self.folders[folder[k]] if folder[k] >= 0 else None,
+        } for k, (p, i, s) in enumerate(zip(self.paths(rows), ids, scores))]
+
+    def mask(self, folder=None, orientation=None, root=None):
+        """Boolean row mask for the given filters, or None when nothing is filtered."""
+        m = None
+        for col, lookup, value in (
+            (self.folder, self._folder_code, folder),
+            (self.orientation, _ORI_CODE, orientation),
+            (self.root, self._root_code, root),
+        ):
+            if not value:
+                continue
+            code = lookup.get(value)
+            if code is None:
+                return np.zeros(len(self), dtype=bool)  # unknown value matches nothing
+            hit = col == code
+            m = hit if m is None else (m & hit)
+        return m
+
+_SELECT = "SELECT id, root, folder, orientation, width, height, path FROM images"
+
+def _select_ids(con, ids):
+    ids = list(dict.fromkeys(np.asarray(ids, dtype=np.int64).tolist()))
+    for s in range(0, len(ids), 500):  # stay under SQLite's bound-variable limit
+        chunk = ids[s:s + 500]
+        yield from con.execute(f"{_SELECT} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+
+def build_attrs(con, ids, base: Attrs | None = None) -> Attrs:
+    """
+    Column arrays in row order (`ids`: images.id per row), in one pass over `images`.
+    With `base` (the columns of the rows before these) only the rows for `ids` are read
+    and their codes extend base's root/folder dictionaries, for appending them to it.
+    """
+    n = len(ids)
+    root = np.full(n, -1, dtype=np.int16)
+    folder = np.full(n, -1, dtype=np.int32)
+    orientation = np.full(n, -1, dtype=np.int8)
+    width = np.full(n, -1, dtype=np.int32)
+    height = np.full(n, -1, dtype=np.int32)
+    path_of = [b""] * n
+    roots = {r: i for i, r in enumerate(base.roots)} if base is not None else {}
+    folders = {f: i for i, f in enumerate(base.folders)} if base is not None else {}
+    img_id, img_root, img_folder, img_ori, img_w, img_h, img_path = [], [], [], [], [], [], []
+    for i, r, f, o, w, h, p in (con.execute(_SELECT) if base is None else _select_ids(con, ids)):
+        img_id.append(i)
+        img_root.append(roots.setdefault(r or "", len(roots)))
+        img_folder.append(folders.setdefault(f or "", len(folders)))
+        img_ori.append(_ORI_CODE.get(o, -1))
+        img_w.append(-1 if w is None else w); img_h.append(-1 if h is None else h)
+        img_path.append(p)
+    if img_id:
+        # rows sharing an id (an old tombstoned copy) all get the image's current values
+        img_id = np.asarray(img_id, dtype=np.int64)
+        order = np.argsort(img_id)
+        sorted_ids = img_id[order]
+        ids = np.asarray(ids, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(sorted_ids, ids), sorted_ids.size - 1)
+        hit = sorted_ids[pos] == ids
+        src = order[pos[hit]]
+        root[hit] = np.asarray(img_root, dtype=np.int16)[src]
+        folder[hit] = np.asarray(img_folder, dtype=np.int32)[src]
+        orientation[hit] = np.asarray(img_ori, dtype=np.int8)[src]
+        width[hit] = np.asarray(img_w, dtype=np.int32)[src]
+        height[hit] = np.asarray(img_h, dtype=np.int32)[src]
+        for r, s in zip(np.flatnonzero(hit).tolist(), src.tolist()):
+            path_of[r] = img_path[s].encode("utf-8")
+    path_off = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in path_of], out=path_off[1:])
+    path_blob = np.frombuffer(b"".join(path_of), dtype=np.uint8)
+    return Attrs(root, folder, orientation, width, height, path_off, path_blob, roots, folders)
+
+def load_attrs(store_dir: str, n: int):
+    """Memory-map persisted columns; None if missing (older stores) or not aligned with the current ids."""
+    paths = [os.path.join(store_dir, name) for name in ATTR_FILES]
+    if not all(os.path.exists(p) for p in paths):
+        return None
+    try:
+        cols = {c: np.load(p, mmap_mode="r") for c, p in zip(COLUMNS, paths)}
+        with open(paths[-1]) as f:
+            d = json.load(f)
+    except Exception:
+        return None
+    if any(cols[c].shape[0] != n for c in COLUMNS[:5]) or cols["path_off"].shape[0] != n + 1:
+        return None
+    if int(cols["path_off"][-1]) != cols["path_blob"].shape[0]:
+        return None
+    return Attrs(**cols, roots=d.get("roots", []), folders=d.get("folders", []))
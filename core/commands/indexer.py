@@ -1,7 +1,21 @@
 import os, sqlite3, time, numpy as np
-from PIL import Image
+from core.helpers.helpers import _append_npy, _atomic_save_npy, _atomic_write_json
+from core.helpers.images import EMBED_SIDE, load_rgb, load_rgb_and_thumb
+from core.helpers.walk import DirWalker, _is_image
+from core.segments import (
+    WRITE_LOCK, commit_manifest, load_ids, load_tombstones, merge_segments, migrate_store,
+    new_segment_name, open_segments, read_manifest, rows_by_id, rows_of, seg_path, write_segment,
+    write_segment_codes,
+)
+from core.folders import ensure_folder_stats
+from core.thumbs import (
+    drop_thumbs, encode_thumb, ensure_thumb_table, open_pack, pregen_format, record_thumbs, thumb_cfg,
+)
 # import faiss
-import json, time
+import json
+import pickle, queue, threading
+from array import array
+from collections import deque
 import logging
 from logging.handlers import RotatingFileHandler
 
@@ -27,38 +41,385 @@ def _ensure_log_handler(store_dir: str):
     ))
     logger.addHandler(fh)
 
-def _atomic_write(path, write_fn):
-    tmp = f"{path}.tmp"
-    write_fn(tmp)
-    os.replace(tmp, path)
+# defaults for the "indexer" block in config.json
+DEFAULT_INDEXER_CFG = {
+    "workers": -1,        # decode/preprocess processes: -1 = auto, 0 = decode inline
+    "queue_batches": 2,   # ready batches buffered ahead of the embedding stage
+    "max_segments": 8,    # compact once a store has more vector segments than this...
+    "max_dead_ratio": 0.25,  # ...or once this fraction of rows is tombstoned
+    "walk_threads": 8,    # directories listed in parallel while scanning the roots
+    "dir_cache": True,    # don't re-list directories whose mtime is unchanged since the last build
+    "defer_indexes": True,  # cold builds: create the secondary indexes once, after the bulk insert
+}
+
+def indexer_cfg(cfg):
+    out = dict(DEFAULT_INDEXER_CFG)
+    out.update((cfg or {}).get("indexer") or {})
+    return out
+
+def _load_cfg(store_dir):
+    """Previous config.json (or {}), so user-set keys survive a rebuild."""
+    try:
+        with open(os.path.join(store_dir, "config.json")) as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def _write_ann(store_dir, X, cfg, n_keep=0):
+    """
+    Persist IVF lists when config asks for them, else drop stale ones. Existing
+    centroids are reused for rows < n_keep unless the library outgrew them; rows
+    only appended after those go to the tail file instead of regrouping every list.
+    """
+    from core.ivf_index import IVF_FILES, IVF_TAIL, TAIL_RATIO, _assign, _auto_nlist, extend_ivf, index_cfg, train_ivf
+    icfg = index_cfg(cfg)
+    paths = [os.path.join(store_dir, name) for name in IVF_FILES]
+    tail_path = os.path.join(store_dir, IVF_TAIL)
+    if icfg["type"] != "ivf" or X.shape[0] < int(icfg["min_rows"]):
+        for p in (*paths, tail_path):
+            if os.path.exists(p):
+                os.remove(p)
+        return
+    t0 = time.time()
+    prev = None
+    if n_keep > 0 and all(os.path.exists(p) for p in paths):
+        C, offsets = np.load(paths[0]), np.load(paths[1])
+        list_ids = np.load(paths[2], mmap_mode="r")
+        tail = np.load(tail_path) if os.path.exists(tail_path) else np.empty(0, dtype=np.int64)
+        n_old = int(offsets[-1]) + tail.shape[0]
+        grown = not icfg["nlist"] and _auto_nlist(X.shape[0]) >= 2 * C.shape[0]
+        if C.shape[1] == X.shape[1] and n_old >= n_keep and not grown:
+            prev = (C, offsets, list_ids, tail)
+    if prev is not None and n_old == n_keep and tail.shape[0] + X.shape[0] - n_keep <= TAIL_RATIO * X.shape[0]:
+        if X.shape[0] == n_keep:
+            return  # nothing appended (deletions are tombstones)
+        labels = _assign(X[n_keep:], C)
+        if tail.shape[0]:
+            _append_npy(tail_path, labels)
+        else:
+            _atomic_save_npy(tail_path, labels)
+        how = "appended"
+    else:
+        if prev is not None:
+            offsets, list_ids = extend_ivf(X, *prev[:3], n_keep=n_keep, tail=prev[3])
+            how = "extended"
+        else:
+            C, offsets, list_ids = train_ivf(X, nlist=int(icfg["nlist"]))
+            how = "trained"
+        for p, arr in zip(paths, (C, offsets, list_ids)):
+            _atomic_save_npy(p, arr)
+        if os.path.exists(tail_path):
+            os.remove(tail_path)  # folded into the lists
+    logger.info("IVF %s: nlist=%d rows=%d in %.1fs", how, C.shape[0], X.shape[0], time.time() - t0)
+
+def _ensure_quantized(store_dir, segments, kind):
+    """Give every segment a quantized copy matching config (only missing ones are written)."""
+    out = []
+    for seg in segments:
+        if (seg.get("quant") or "none") != kind:
+            X = np.load(seg_path(store_dir, seg["name"], "vectors"), mmap_mode="r")
+            seg = {**seg, "quant": write_segment_codes(store_dir, seg["name"], X, kind)}
+            logger.info("Quantized segment %s: %s", seg["name"], kind)
+        out.append(seg)
+    return out
+
+def _attrs_for(store_dir, con, old_ids, embed_ids):
+    """
+    (attrs, append) for the store after a build: just the new segment's rows on top of
+    the columns on disk, or every row when there are none to extend (cold build, older
+    store). Rows tombstoned since keep their stale values; nothing reads them.
+    """
+    from core.attrs import build_attrs, load_attrs
+    base = load_attrs(store_dir, len(old_ids)) if len(old_ids) else None
+    if base is None:
+        return build_attrs(con, np.concatenate([old_ids, embed_ids])), False
+    return build_attrs(con, embed_ids, base=base), True
+
+def _write_attrs(store_dir, attrs, append=False):
+    """Write the attr columns, or with `append` add attrs' rows to the end of the ones on disk."""
+    from core.attrs import ATTR_FILES, COLUMNS
+    paths = dict(zip(COLUMNS, (os.path.join(store_dir, name) for name in ATTR_FILES)))
+    # the dictionaries only ever grow, so existing codes stay valid
+    _atomic_write_json(os.path.join(store_dir, ATTR_FILES[-1]), {"roots": attrs.roots, "folders": attrs.folders})
+    if not append:
+        for col, p in paths.items():
+            _atomic_save_npy(p, np.asarray(getattr(attrs, col)))
+        return
+    if not len(attrs):
+        return
+    for col in COLUMNS[:5]:
+        _append_npy(paths[col], getattr(attrs, col))
+    # path_off last: load_attrs checks it against the blob and the other columns
+    blob_end = _append_npy(paths["path_blob"], attrs.path_blob)
+    _append_npy(paths["path_off"], attrs.path_off[1:] + blob_end)
+
+def _collect_paths(roots, workers=8):
+    for root, p, _, _ in DirWalker(roots, workers=workers):
+        yield root, p
+
+def _dir_cache(con, live_row):
+    """
+    (directory cache, {dir: indexed paths}) for DirWalker from the last good build,
+    minus entries that no longer agree with the vectors on disk (e.g. a file there
+    failed to embed, or the store was wiped).
+    """
+    live = {}
+    for p in live_row:
+        live.setdefault(os.path.dirname(p), []).append(p)
+    cache = {}
+    for d, mtime, subdirs, nfiles in con.execute("SELECT path, mtime, subdirs, nfiles FROM dirs"):
+        if nfiles == len(live.get(d, ())):
+            cache[d] = [mtime, json.loads(subdirs), nfiles]
+    return cache, live
+
+def _save_dir_cache(con, listing):
+    con.execute("DELETE FROM dirs")
+    con.executemany("INSERT INTO dirs(path, mtime, subdirs, nfiles) VALUES(?,?,?,?)",
+                    ((d, m, json.dumps(subs), n) for d, (m, subs, n) in listing.items()))
+
+def _thumbs(store_dir, cfg):
+    """(thumb dir, thumbnail config) when thumbnails are made while indexing, else None."""
+    tcfg = thumb_cfg(cfg)
+    return (os.path.join(store_dir, "thumbs"), tcfg) if tcfg["pregenerate"] else None
+
+def _decode_for_embedding(path, preprocess, thumbs=None):
+    """
+    Open + preprocess one image -> ((width, height), float32 array [3,H,W], thumb JPEG).
+    With `thumbs` (a thumbnail config), the thumbnail is encoded from the same decode.
+    """
+    blob = None
+    if thumbs is None:
+        # reduced-resolution decode; width/height still come from the header
+        size, im = load_rgb(path, min_side=EMBED_SIDE)
+    else:
+        size, im, thumb = load_rgb_and_thumb(path, EMBED_SIDE, int(thumbs["size"]))
+        try:
+            blob = encode_thumb(path, thumbs, im=thumb)
+        except Exception:
+            pass  # /thumb makes it on demand later
+    t = preprocess(im)
+    # plain arrays pickle cheaply across the process boundary
+    return size, (t.numpy() if hasattr(t, "numpy") else np.asarray(t)), blob
+
+# per-process state for the decode pool
+_worker_preprocess = None
+_worker_thumbs = None
+
+def _init_decode_worker(preprocess, thumbs=None):
+    global _worker_preprocess, _worker_thumbs
+    _worker_preprocess, _worker_thumbs = preprocess, thumbs
+    try:
+        import torch
+        torch.set_num_threads(1)  # parallelism comes from the pool, not intra-op threads
+    except Exception:
+        pass
+
+def _decode_in_worker(path):
+    return _decode_for_embedding(path, _worker_preprocess, _worker_thumbs)
+
+def _decode_workers(icfg, n_todo, batch_size, preprocess):
+    """How many decode processes to use for this run (0 = inline)."""
+    workers = int(icfg["workers"])
+    if workers < 0:
+        workers = max(1, min(4, (os.cpu_count() or 2) - 1))
+    # spawning workers costs a model-transform import each; not worth it for a handful
+    if workers == 0 or n_todo < 2 * batch_size:
+        return 0
+    try:
+        pickle.dumps(preprocess)
+    except Exception:
+        logger.warning("preprocess is not picklable; decoding inline")
+        return 0
+    return workers
+
+def _decoded(items, preprocess, workers, window, check_cancel, thumbs=None):
+    """
+    Yield (item, result, error) for (root, path, ...) items in input order.
+    With workers > 0, up to `window` files are decoded ahead on a process pool.
+    """
+    if workers <= 0:
+        for item in items:
+            check_cancel()
+            try:
+                yield item, _decode_for_embedding(item[1], preprocess, thumbs), None
+            except Exception as e:
+                yield item, None, e
+        return
 
-def _atomic_save_npy(path, array, **kwargs):
-    tmp = f"{path}.tmp"
-    with open(tmp, "wb") as f:
-        # allow_pickle required for dtype=object ids
-        np.save(f, array, **kwargs)
-    os.replace(tmp, path)
+    import multiprocessing as mp
+    from concurrent.futures import ProcessPoolExecutor
 
-def _collect_paths(roots):
-    for root in roots:
-        for dirpath, _, files in os.walk(root):
-            for f in files:
-                if os.path.splitext(f)[1].lower() in {".jpg",".jpeg",".png",".webp",".bmp",".tiff",".tif"}:
-                    yield root, os.path.join(dirpath, f)
+    def _collect(item, fut):
+        try:
+            return item, fut.result(), None
+        except Exception as e:
+            return item, None, e
+
+    # spawn: forking a process that already runs torch threads can deadlock
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"),
+                               initializer=_init_decode_worker, initargs=(preprocess, thumbs))
+    pending = deque()
+    try:
+        for item in items:
+            check_cancel()
+            pending.append((item, pool.submit(_decode_in_worker, item[1])))
+            if len(pending) >= window:
+                yield _collect(*pending.popleft())
+        while pending:
+            check_cancel()
+            yield _collect(*pending.popleft())
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+class _EmbedStage:
+    """Background thread embedding ready batches, fed through a bounded queue."""
+    def __init__(self, model, device, depth):
+        self.model, self.device = model, device
+        self.ids, self.vecs = [], []
+        self.error = None
+        self._aborted = False
+        self._q = queue.Queue(maxsize=max(1, int(depth)))
+        self._t = threading.Thread(target=self._run, daemon=True)
+        self._t.start()
+
+    def _run(self):
+        from core.models import embed_images
+        while True:
+            item = self._q.get()
+            if item is None:
+                return
+            if self._aborted or self.error is not None:
+                continue  # drain
+            batch_ids, batch_imgs = item
+            try:
+                feats = embed_images(self.model, batch_imgs, device=self.device)  # [B,D], normalized
+                self.vecs.append(feats); self.ids.extend(batch_ids)
+            except BaseException as e:
+                self.error = e
+
+    def put(self, batch_ids, batch_imgs, check_cancel):
+        # block while the embedder is behind, but keep honouring cancel
+        while True:
+            check_cancel()
+            if self.error is not None:
+                raise self.error
+            try:
+                self._q.put((batch_ids, batch_imgs), timeout=0.2)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self):
+        self._q.put(None)
+        self._t.join()
+        if self.error is not None:
+            raise self.error
+        return self.ids, self.vecs
+
+    def abort(self):
+        self._aborted = True
+        # drop the queued batches (freeing them now) so the stop sentinel always fits;
+        # we are the only producer, so nothing refills the queue in between
+        while True:
+            try:
+                self._q.get_nowait()
+            except queue.Empty:
+                break
+        self._q.put(None)
+
+def _stat_files(paths):
+    """(root, path) -> (root, path, mtime, size); files that vanish mid-walk are skipped."""
+    for root, p in paths:
+        try:
+            st = os.stat(p)
+        except OSError:
+            logger.warning("Skipping unreadable file: %s", p)
+            continue
+        yield root, p, st.st_mtime, st.st_size
+
+def _db_stats(con, paths=None):
+    """
+    (path -> slot, mtime[slot], size[slot]) for every row (or just `paths`) in one
+    pass over the table; size is -1 for rows written before the column existed.
+    """
+    slot, mtimes, sizes = {}, array("d"), array("q")
+    def _add(rows):
+        for p, m, sz in rows:
+            slot[p] = len(mtimes)
+            mtimes.append(m or 0.0); sizes.append(sz)
+    if paths is None:
+        _add(con.execute("SELECT path, mtime, IFNULL(size, -1) FROM images"))
+    else:
+        paths = list(paths)
+        for s in range(0, len(paths), 500):  # stay under SQLite's bound-variable limit
+            chunk = paths[s:s + 500]
+            _add(con.execute(f"SELECT path, mtime, IFNULL(size, -1) FROM images WHERE path IN ({','.join('?' * len(chunk))})", chunk))
+    return slot, np.frombuffer(mtimes, dtype=np.float64), np.frombuffer(sizes, dtype=np.int64)
+
+def _diff_files(files, db, live_row):
+    """
+    Bulk change detection of walked (root, path, mtime, size) files against _db_stats().
+    Returns (todo files, vector rows they replace, DB paths not walked, counts).
+    """
+    slot, db_mtime, db_size = db
+    n = len(files)
+    idx = np.fromiter((slot.get(f[1], -1) for f in files), dtype=np.int64, count=n)
+    row = np.fromiter((live_row.get(f[1], -1) for f in files), dtype=np.int64, count=n)
+    known = idx >= 0
+    unchanged = np.zeros(n, dtype=bool)
+    if db_mtime.size:
+        j = np.where(known, idx, 0)
+        mtime = np.fromiter((f[2] for f in files), dtype=np.float64, count=n)
+        size = np.fromiter((f[3] for f in files), dtype=np.int64, count=n)
+        same = (np.abs(db_mtime[j] - mtime) < 1e-6) & ((db_size[j] == size) | (db_size[j] < 0))
+        # a row without a live vector (e.g. its embedding failed) is redone too
+        unchanged = known & same & (row >= 0)
+
+    seen = np.zeros(db_mtime.size, dtype=bool)
+    seen[idx[known]] = True
+    deleted = [p for p, i in slot.items() if not seen[i]]
+
+    redo = np.flatnonzero(~unchanged)
+    todo = [files[i] for i in redo]
+    replaced = row[redo]
+    replaced = replaced[replaced >= 0].tolist()  # old rows are tombstoned once the new ones land
+    counts = {
+        "new": int((~known).sum()),
+        "changed": int((known & ~unchanged).sum()),
+        "deleted": len(deleted),
+        "unchanged": int(unchanged.sum()),
+    }
+    return todo, replaced, deleted, counts
 
-# so that we don't reindex old files
-def _is_file_up_to_date(con, path, mtime):
-    row = con.execute("SELECT mtime FROM images WHERE path=?", (path,)).fetchone()
-    return row is not None and abs(row[0] - mtime) < 1e-6
 
 
+# secondary indexes on images (UNIQUE(path) is part of the table)
+_IMAGE_INDEXES = {
+    "idx_images_root": "images(root)",
+    "idx_images_top_folder": "images(top_folder)",
+    "idx_images_folder": "images(folder)",
+    "idx_images_orientation": "images(orientation)",
+    "idx_images_root_top": "images(root, top_folder)",
+}
 
-def ensure_db(db_path: str) -> sqlite3.Connection:
+def create_image_indexes(con):
+    for name, on in _IMAGE_INDEXES.items():
+        con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {on};")
+    con.commit()
+
+def ensure_db(db_path: str, analyze: bool = True, defer_indexes: bool = False) -> sqlite3.Connection:
+    """
+    Open (creating/upgrading) meta.sqlite for writing. With `defer_indexes` and an empty
+    `images` table, its secondary indexes are left out; call create_image_indexes() after
+    the bulk insert.
+    """
     con = sqlite3.connect(db_path, check_same_thread=False, timeout=5.0)
     # Pragmas for better durability/perf in a local app
     con.execute("PRAGMA busy_timeout=5000;")  
     con.execute("PRAGMA journal_mode=WAL;")
     con.execute("PRAGMA synchronous=NORMAL;")
+    # INSERT OR REPLACE must fire the delete triggers too (folder_stats)
+    con.execute("PRAGMA recursive_triggers=ON;")
     con.execute("""CREATE TABLE IF NOT EXISTS images(
         id INTEGER PRIMARY KEY,
         path TEXT UNIQUE,           -- absolute file path
@@ -67,23 +428,48 @@ def ensure_db(db_path: str) -> sqlite3.Connection:
         top_folder TEXT,            -- first component of subpath
         folder TEXT,                -- legacy alias of top_folder (used by current code)
         mtime REAL,
+        size INT,                   -- bytes; with mtime, decides whether a file changed
         width INT,
         height INT,
         orientation TEXT            -- landscape|portrait|square
     );""")
+    # per-directory listing cache for rescans (see DirWalker)
+    con.execute("""CREATE TABLE IF NOT EXISTS dirs(
+        path TEXT PRIMARY KEY,
+        mtime REAL,
+        subdirs TEXT,               -- JSON list of subdirectory names
+        nfiles INT                  -- image files listed in it
+    );""")
+    if "size" not in {r[1] for r in con.execute("PRAGMA table_info(images)")}:
+        con.execute("ALTER TABLE images ADD COLUMN size INT;")  # stores from before the column
+    ensure_thumb_table(con)
     # Helpful indexes for your /folders endpoint & filters
-    con.execute("CREATE INDEX IF NOT EXISTS idx_images_root ON images(root);")
-    con.execute("CREATE INDEX IF NOT EXISTS idx_images_top_folder ON images(top_folder);")
-    con.execute("CREATE INDEX IF NOT EXISTS idx_images_folder ON images(folder);")
-    con.execute("CREATE INDEX IF NOT EXISTS idx_images_orientation ON images(orientation);")
-
-    con.execute("CREATE INDEX IF NOT EXISTS idx_images_root_top ON images(root, top_folder);")
+    if defer_indexes and con.execute("SELECT 1 FROM images LIMIT 1").fetchone() is None:
+        for name in _IMAGE_INDEXES:
+            con.execute(f"DROP INDEX IF EXISTS {name};")
+    else:
+        create_image_indexes(con)
+    ensure_folder_stats(con)  # per-directory counts behind /folders
 
     con.commit()
-    con.execute("ANALYZE;")
+    if analyze:  # a full-table pass; skipped for small incremental updates
+        con.execute("ANALYZE;")
     return con
 
-def upsert_meta(con: sqlite3.Connection, path: str, width: int, height: int, mtime: float, root: str):
+# mtime/size of a row that already exists are left alone here and stamped by
+# _stamp_meta() once its new vector is committed, so an interrupted build redoes
+# the file instead of keeping the old vector. The row keeps its id.
+_UPSERT = """
+    INSERT INTO images(path, root, subpath, top_folder, folder, mtime, size, width, height, orientation)
+    VALUES(?,?,?,?,?,?,?,?,?,?)
+    ON CONFLICT(path) DO UPDATE SET
+        root=excluded.root, subpath=excluded.subpath, top_folder=excluded.top_folder,
+        folder=excluded.folder, width=excluded.width, height=excluded.height,
+        orientation=excluded.orientation
+"""
+
+def meta_row(path: str, width: int, height: int, mtime: float, root: str, size: int = None):
+    """The images row for one file, in _UPSERT's column order."""
     # Derive root/subpath/top_folder robustly
     try:
         rel = os.path.relpath(path, root)
@@ -96,127 +482,232 @@ def upsert_meta(con: sqlite3.Connection, path: str, width: int, height: int, mti
     parts = rel.split(os.sep) if rel else []
     top = parts[0] if parts else ""
     ori = "square" if width == height else ("landscape" if width > height else "portrait")
+    return (path, root, rel, top, top, mtime, size, width, height, ori)
 
-    con.execute("""
-        INSERT OR REPLACE INTO images(path, root, subpath, top_folder, folder, mtime, width, height, orientation)
-        VALUES(?,?,?,?,?,?,?,?,?)
-    """, (path, root, rel, top, top, mtime, width, height, ori))
+def _stamp_meta(store_dir, stamps):
+    """Record (mtime, size, path) of re-embedded files now that their vectors are committed."""
+    if not stamps:
+        return
+    con = sqlite3.connect(os.path.join(store_dir, "meta.sqlite"), timeout=5.0)
+    try:
+        con.execute("PRAGMA busy_timeout=5000;")
+        with con:
+            con.executemany("UPDATE images SET mtime=?, size=? WHERE path=?", stamps)
+    finally:
+        con.close()
+
+def _embed_files(con, todo, model, preprocess, device, batch_size, icfg, check_cancel, tick=None, thumbs=None, known=()):
+    """
+    Decode + embed (root, path, mtime, size) items, upserting their metadata (and, with
+    `thumbs` = (thumb dir, config), packing their thumbnails) one embedding batch at a time.
+    Returns (images.id per embedded row, list of [B, D] feature batches, error count,
+    (mtime, size, path) stamps for the files of `known` paths to pass to _stamp_meta).
+    """
+    workers = _decode_workers(icfg, len(todo), batch_size, preprocess)
+    logger.info("Embedding %d files (decode workers=%d, thumbnails=%s)", len(todo), workers, thumbs is not None)
+    embedder = _EmbedStage(model, device, depth=icfg["queue_batches"])
+    decoded = _decoded(todo, preprocess, workers, window=batch_size + 4 * workers,
+                       check_cancel=check_cancel, thumbs=thumbs and thumbs[1])
+    pack = open_pack(*thumbs) if thumbs else None
+    variant = (int(thumbs[1]["size"]), pregen_format(thumbs[1])) if thumbs else None
+
+    errors = 0
+    pending_meta, pending_thumbs, stamps = [], [], []
+    meta = {"rows": 0, "batches": 0, "time": 0.0}
+
+    def _flush_meta():
+        # one executemany + one transaction per embedding batch
+        if not pending_meta and not pending_thumbs:
+            return
+        t0 = time.perf_counter()
+        with con:
+            con.executemany(_UPSERT, pending_meta)
+            # a changed image's other sizes/formats are stale now
+            drop_thumbs(con, [row[0] for row in pending_meta])
+            record_thumbs(con, pending_thumbs)
+        meta["time"] += time.perf_counter() - t0
+        meta["rows"] += len(pending_meta); meta["batches"] += 1
+        pending_meta.clear(); pending_thumbs.clear()
+
+    batch_imgs, batch_ids = [], []
+    try:
+        for (root, p, mtime, size), res, err in decoded:
+            if err is not None:
+                errors += 1
+                logger.error("Failed processing file: %s", p, exc_info=err)
+            else:
+                (width, height), arr, blob = res
+                pending_meta.append(meta_row(p, width, height, mtime, root, size))
+                if p in known:
+                    stamps.append((mtime, size, p))
+                if blob and pack is not None:
+                    pending_thumbs.append((p, *variant, *pack.put(blob)))
+                batch_imgs.append(arr); batch_ids.append(p)
+                if len(batch_imgs) >= batch_size:
+                    _flush_meta()
+                    embedder.put(batch_ids, batch_imgs, check_cancel)
+                    batch_imgs, batch_ids = [], []
+            if tick:
+                tick()
 
-def build_index_with_progress(roots, store_dir, model, preprocess, progress_cb=None, batch_size=64, device="cpu", stop_event=None,):
+        _flush_meta()
+        if batch_imgs:
+            embedder.put(batch_ids, batch_imgs, check_cancel)
+        embed_paths, embed_vecs = embedder.finish()
+    except BaseException:
+        embedder.abort()
+        raise
+    finally:
+        decoded.close()
+    logger.info("Metadata: rows=%d batches=%d time=%.2fs", meta["rows"], meta["batches"], meta["time"])
+    return _image_ids(con, embed_paths), embed_vecs, errors, stamps
+
+def _image_ids(con, paths):
+    """images.id of each path, as the int64 array vector rows are keyed by."""
+    id_of = {}
+    for s in range(0, len(paths), 500):  # stay under SQLite's bound-variable limit
+        chunk = paths[s:s + 500]
+        id_of.update(con.execute(f"SELECT path, id FROM images WHERE path IN ({','.join('?' * len(chunk))})", chunk))
+    return np.fromiter((id_of[p] for p in paths), dtype=np.int64, count=len(paths))
+
+def _commit_vectors(store_dir, cfg, prev, old_ids, dead, embed_ids, embed_vecs, attrs, deleted=0):
+    """
+    Append-only write: new rows become a new segment, deletions a new tombstone
+    bitmap; then extend the row-aligned attrs (`attrs` from _attrs_for()) and IVF
+    lists. Returns open_segments().
+    """
+    from core.ivf_index import index_cfg
+    kind = index_cfg(cfg)["quantize"]
+    segments = _ensure_quantized(store_dir, list((prev or {}).get("segments", [])), kind)
+    if len(embed_ids):
+        X_new = np.vstack(embed_vecs).astype("float32")
+        segments.append(write_segment(store_dir, new_segment_name(prev), embed_ids, X_new, kind))
+        dead = np.concatenate([dead, np.zeros(len(embed_ids), dtype=bool)])
+    if len(embed_ids) or deleted or segments != (prev or {}).get("segments"):
+        commit_manifest(store_dir, prev, segments, dead)
+
+    store = open_segments(store_dir)
+    _write_attrs(store_dir, *attrs)
+    _write_ann(store_dir, store["X"], cfg, n_keep=len(old_ids))
+    return store
+
+def _previous_rows(store_dir, con, paths=None):
+    """
+    (manifest, row ids, tombstones, {live path: row}, orphan rows) of the store as it is
+    on disk. Orphans are live rows whose images.id no longer exists (their images row
+    was deleted by a build that got cancelled); callers tombstone them.
+    With `paths`, only those are looked up and orphans are left for the next full build.
+    """
+    migrate_store(store_dir, con)
+    prev = read_manifest(store_dir)
+    if prev is None or not prev["segments"]:
+        logger.info("No carry-forward vectors found (cold build)")
+        old_ids, dead = np.empty(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    else:
+        old_ids, dead = load_ids(store_dir, prev), load_tombstones(store_dir, prev)
+    if paths is not None:
+        path_of = {}
+        paths = list(paths)
+        for s in range(0, len(paths), 500):  # stay under SQLite's bound-variable limit
+            chunk = paths[s:s + 500]
+            path_of.update(con.execute(f"SELECT id, path FROM images WHERE path IN ({','.join('?' * len(chunk))})", chunk))
+        rows = np.flatnonzero(np.isin(old_ids, np.fromiter(path_of, dtype=np.int64, count=len(path_of))) & ~dead)
+        return prev, old_ids, dead, {path_of[int(old_ids[r])]: int(r) for r in rows}, []
+    alive = np.flatnonzero(~dead)
+    row_of = dict(zip(np.asarray(old_ids)[alive].tolist(), alive.tolist()))
+    live_row = {}
+    for iid, path in con.execute("SELECT id, path FROM images"):
+        r = row_of.pop(iid, None)
+        if r is not None:
+            live_row[path] = r
+    return prev, old_ids, dead, live_row, list(row_of.values())
+
+def build_index_with_progress(roots, store_dir, model, preprocess, progress_cb=None, batch_size=64, device="cpu", stop_event=None, scan_cb=None):
+    # builds and compactions both rewrite the manifest; never interleave them
+    with WRITE_LOCK:
+        return _build_index(roots, store_dir, model, preprocess, progress_cb, batch_size, device, stop_event, scan_cb)
+
+def _build_index(roots, store_dir, model, preprocess, progress_cb, batch_size, device, stop_event, scan_cb=None):
     _ensure_log_handler(store_dir)
     logger.info("Index start: roots=%s batch_size=%d device=%s", roots, batch_size, device)
     
     os.makedirs(store_dir, exist_ok=True)
     db = os.path.join(store_dir, "meta.sqlite")
-    con = ensure_db(db)
+    cfg = _load_cfg(store_dir)
+    icfg = indexer_cfg(cfg)
+    con = ensure_db(db, defer_indexes=icfg["defer_indexes"])
+    # cold build: the secondary indexes are built once the rows are in
+    deferred = con.execute("SELECT 1 FROM sqlite_master WHERE name='idx_images_root'").fetchone() is None
 
     def _check_cancel():
         if stop_event is not None and stop_event.is_set():
             raise CancelledError()
 
-    from core.models import embed_images
-    ids, vecs = [], []
+    # --- Previous segments: unchanged rows stay where they are ---
+    prev, old_ids, dead, live_row, orphans = _previous_rows(store_dir, con)
 
-    # --- Load previous vectors/ids for carry-forward ---
-    old_ids_path  = os.path.join(store_dir, "ids.npy")
-    old_vecs_path = os.path.join(store_dir, "vectors.npy")
-    old_map = None
-    if not os.path.exists(old_ids_path) or not os.path.exists(old_vecs_path):
-        logger.info("No carry-forward vectors found (cold build)")
-    if os.path.exists(old_ids_path) and os.path.exists(old_vecs_path):
-        old_ids  = np.load(old_ids_path, allow_pickle=True)
-        old_vecs = np.load(old_vecs_path, mmap_mode="r")  # [N,D]
-        old_index = {str(p): i for i, p in enumerate(old_ids)}
-        old_map = (old_vecs, old_index)
+    done = 0
+    total = 0
+    errors = 0
 
-    # --- Collect current files (single pass) ---
-    paths = list(_collect_paths(roots))
-    total = len(paths)
-    current_set = set(p for _, p in paths)
-
-    _check_cancel()
+    def _tick():
+        nonlocal done
+        done += 1
+        if progress_cb and (done % 50 == 0 or done == total):
+            progress_cb(done, total)
 
     try:
-        # --- Remove DB rows for files no longer present ---
-        cur = con.cursor()
-        to_del = []
-        for (p,) in cur.execute("SELECT path FROM images"):
-            if p not in current_set:
-                to_del.append((p,))
-        if to_del:
-            logger.info("Pruning %d missing files from DB", len(to_del))
-            cur.executemany("DELETE FROM images WHERE path=?", to_del)
-        con.commit()
-
-        batch_imgs, batch_ids = [], []
-        done = 0
-        errors = 0
-        since_commit = 0
-        BATCH_COMMIT = 200
+        # --- Walk the roots; directories unchanged since the last build are not re-listed ---
+        cache, known = _dir_cache(con, live_row) if icfg["dir_cache"] else (None, None)
+        walker = DirWalker(roots, workers=int(icfg["walk_threads"]), cache=cache, known=known)
+        files = []
+        for f in walker:
+            files.append(f)
+            if len(files) % 1000 == 0:
+                _check_cancel()
+        _check_cancel()
 
-        for root, p in paths:
-            _check_cancel()
+        # --- Bulk diff against the DB: new / changed / deleted / unchanged ---
+        db_rows = _db_stats(con)
+        todo, replaced, deleted, counts = _diff_files(files, db_rows, live_row)
+        kept = counts["unchanged"]
+        total = len(todo) + kept
+        logger.info("Scan: %s (listing skipped for %d unchanged dirs)", counts, len(walker.trusted))
+        if scan_cb:
+            scan_cb(counts)
+        _check_cancel()
 
-            try:
-                mtime = os.path.getmtime(p)
-
-                # If unchanged, carry forward existing vector (if we have it)
-                if _is_file_up_to_date(con, p, mtime):
-                    if old_map is not None:
-                        old_vecs, old_index = old_map
-                        i = old_index.get(p)
-                        if i is not None:
-                            ids.append(p)
-                            # 1xD to match batch shapes for vstack
-                            vecs.append(np.array(old_vecs[i], dtype="float32", copy=True)[None, :])
-                    continue
-
-                # Changed or new: read, upsert meta, queue for embedding
-                with Image.open(p) as im_raw:
-                    _check_cancel()
-                    im = im_raw.convert("RGB")
-                    width, height = im.size
-                upsert_meta(con, p, width, height, mtime, root)
-
-                t = preprocess(im)
-                batch_imgs.append(t); batch_ids.append(p)
-
-                since_commit += 1
-
-                # reduce lock window: commit metadata periodically
-                if since_commit >= BATCH_COMMIT:
-                    con.commit()
-                    since_commit = 0
-
-                # before long compute (embedding), release writer lock
-                if len(batch_imgs) >= batch_size:
-                    _check_cancel()
-                    if since_commit:
-                        con.commit()
-                        since_commit = 0
-                    feats = embed_images(model, batch_imgs, device=device)  # [B,D], normalized
-                    vecs.append(feats); ids.extend(batch_ids)
-                    batch_imgs, batch_ids = [], []
+        # --- Remove DB rows (and tombstone vectors) for files no longer present ---
+        if deleted:
+            logger.info("Pruning %d missing files from DB", len(deleted))
+            con.executemany("DELETE FROM images WHERE path=?", [(p,) for p in deleted])
+            drop_thumbs(con, deleted)
+        con.commit()
+        gone = orphans + [live_row[p] for p in deleted if p in live_row]
 
-            except Exception:
-                errors += 1
-                logger.exception("Failed processing file: %s", p)
-            finally:
-                done += 1
-                if progress_cb and (done % 50 == 0 or done == total):
-                    progress_cb(done, total)
+        done = kept  # unchanged files need no more work
+        if progress_cb:
+            progress_cb(done, total)
 
-        if batch_imgs:
-            _check_cancel()
-            if since_commit:
-                con.commit()
-                since_commit = 0
-            feats = embed_images(model, batch_imgs, device=device)
-            vecs.append(feats); ids.extend(batch_ids)
+        # --- Decode/preprocess on a process pool while a thread embeds ready batches ---
+        embed_ids, embed_vecs, failed, stamps = _embed_files(
+            con, todo, model, preprocess, device, batch_size, icfg, _check_cancel, _tick,
+            thumbs=_thumbs(store_dir, cfg), known=db_rows[0])
+        errors += failed
         
         _check_cancel()
+        if icfg["dir_cache"]:
+            _save_dir_cache(con, walker.listing)
         con.commit() # final commit
 
+        dead[gone] = True
+        dead[replaced] = True
+        if kept + len(embed_ids) == 0:
+            raise RuntimeError("No images embedded and no carry-forward vectors.")
+
+        # filter columns aligned with the final row order (old segments + new one)
+        attrs = _attrs_for(store_dir, con, old_ids, embed_ids)
+
     except CancelledError:
         try: con.rollback()
         except Exception: pass
@@ -226,48 +717,226 @@ def build_index_with_progress(roots, store_dir, model, preprocess, progress_cb=N
         except Exception: pass
         raise
     finally:
+        if deferred:
+            t0 = time.perf_counter()
+            create_image_indexes(con)
+            con.execute("ANALYZE;")
+            logger.info("Secondary indexes built in %.2fs", time.perf_counter() - t0)
         try: con.close()
         except Exception: pass
 
-    if not vecs:
-        raise RuntimeError("No images embedded and no carry-forward vectors.")
-
-    # Stack all chunks (both carry-forward rows and embedded batches)
-    X = np.vstack(vecs).astype("float32")
+    logger.info(
+        "Index done: total=%d embedded=%d reused=%d deleted=%d errors=%d",
+        total, len(embed_ids), kept, len(gone) + len(replaced), errors
+    )
 
+    store = _commit_vectors(store_dir, cfg, prev, old_ids, dead, embed_ids, embed_vecs, attrs,
+                            deleted=len(gone) + len(replaced))
+    _stamp_meta(store_dir, stamps)
 
-    logger.info(
-        "Index done: total=%d embedded=%d reused=%d errors=%d",
-        total,
-        sum(getattr(a, "shape", (0,))[0] if hasattr(a, "shape") else len(a) for a in vecs),
-        len(ids) - (sum(getattr(a, "shape", (0,))[0] if hasattr(a, "shape") else len(a) for a in vecs)),
-        errors
-    )   
-
-    # Write index + arrays atomically
-    # index = faiss.IndexFlatIP(X.shape[1])
-    # index.add(X)
-
-    # index_path = os.path.join(store_dir, "index.faiss")
-    vecs_path  = os.path.join(store_dir, "vectors.npy")
-    ids_path   = os.path.join(store_dir, "ids.npy")
-
-    _atomic_save_npy(ids_path, np.array(ids, dtype=object), allow_pickle=True)
-    # _atomic_write(index_path, lambda p: faiss.write_index(index, p))
-    _atomic_save_npy(vecs_path, X)
-
-    # Save config with merged roots
-    cfg = {
+    # Save config with merged roots (keeping user settings like "index")
+    cfg.update({
         "model": "ViT-B-32/laion2b_s34b_b79k",
-        "dim": int(X.shape[1]),
+        "dim": int(store["X"].shape[1]),
         "created": time.time(),
         "roots": roots,  # ← keep
-    }
-    _atomic_write(os.path.join(store_dir, "config.json"),
-                  lambda p: open(p, "w").write(json.dumps(cfg)))
+    })
+    _atomic_write_json(os.path.join(store_dir, "config.json"), cfg)
+
+def _root_of(path, roots):
+    for r in roots:
+        if path == r or path.startswith(r.rstrip(os.sep) + os.sep):
+            return r
+    return None
+
+def update_paths(paths, roots, store_dir, model, preprocess, batch_size=64, device="cpu", stop_event=None):
+    """
+    Re-index only `paths` (files or directories under `roots`, e.g. from the watcher):
+    new/changed images are embedded into a new segment, vanished ones are tombstoned.
+    Returns {"embedded", "deleted", "errors"}.
+    """
+    with WRITE_LOCK:
+        return _update_paths(paths, roots, store_dir, model, preprocess, batch_size, device, stop_event)
+
+def _update_paths(paths, roots, store_dir, model, preprocess, batch_size, device, stop_event):
+    _ensure_log_handler(store_dir)
+    cfg = _load_cfg(store_dir)
+    icfg = indexer_cfg(cfg)
+
+    def _check_cancel():
+        if stop_event is not None and stop_event.is_set():
+            raise CancelledError()
+
+    # --- Expand the changed paths: directories are walked, vanished ones become prefixes ---
+    found, prefixes = {}, []
+    for p in paths:
+        root = _root_of(p, roots)
+        if root is None:
+            continue
+        if os.path.isdir(p):
+            found.update((f, root) for _, f in _collect_paths([p]))
+            prefixes.append(p.rstrip(os.sep) + os.sep)
+        elif os.path.isfile(p):
+            if _is_image(p):
+                found[p] = root
+        else:
+            # deleted/moved away: a file, or a directory with indexed files under it
+            prefixes.append(p)
+
+    stats = {"embedded": 0, "deleted": 0, "errors": 0}
+    if not found and not prefixes:
+        return stats
+
+    con = ensure_db(os.path.join(store_dir, "meta.sqlite"), analyze=False)
+    try:
+        # --- Indexed paths under the changed prefixes that are no longer on disk ---
+        gone_paths = set()
+        for pre in prefixes:
+            # path range scan on the UNIQUE(path) index instead of LIKE
+            hi = pre[:-1] + chr(ord(pre[-1]) + 1)
+            for (q,) in con.execute("SELECT path FROM images WHERE path >= ? AND path < ?", (pre, hi)):
+                under = pre.endswith(os.sep) or q == pre or q.startswith(pre + os.sep)
+                if under and q not in found:
+                    gone_paths.add(q)
+        # rows of just the touched paths, not the whole library
+        prev, old_ids, dead, live_row, orphans = _previous_rows(store_dir, con, [*found, *gone_paths])
+        if gone_paths:
+            con.executemany("DELETE FROM images WHERE path=?", [(q,) for q in gone_paths])
+            drop_thumbs(con, gone_paths)
+            con.commit()
+        gone = orphans + [live_row[q] for q in gone_paths if q in live_row]
+
+        # --- New or modified files ---
+        files = list(_stat_files((r, p) for p, r in found.items()))
+        db_rows = _db_stats(con, found)
+        todo, replaced, _, _ = _diff_files(files, db_rows, live_row)
+
+        embed_ids, embed_vecs, errors, stamps = np.empty(0, dtype=np.int64), [], 0, []
+        if todo:
+            embed_ids, embed_vecs, errors, stamps = _embed_files(
+                con, todo, model, preprocess, device, batch_size, icfg, _check_cancel,
+                thumbs=_thumbs(store_dir, cfg), known=db_rows[0])
+        _check_cancel()
+        con.commit()
+
+        stats = {"embedded": len(embed_ids), "deleted": len(gone), "errors": errors}
+        if not len(embed_ids) and not gone and not replaced:
+            return stats
+
+        dead[gone] = True
+        dead[replaced] = True
+        attrs = _attrs_for(store_dir, con, old_ids, embed_ids)
+    except Exception:
+        try: con.rollback()
+        except Exception: pass
+        raise
+    finally:
+        try: con.close()
+        except Exception: pass
+
+    _commit_vectors(store_dir, cfg, prev, old_ids, dead, embed_ids, embed_vecs, attrs,
+                    deleted=len(gone) + len(replaced))
+    _stamp_meta(store_dir, stamps)
+    logger.info("Watch update: embedded=%d deleted=%d errors=%d", len(embed_ids), len(gone), errors)
+    return stats
+
+def drop_roots(roots, survivors, store_dir):
+    """
+    Forget everything indexed under `roots` without rescanning the survivors: their
+    images/thumbs/dirs rows go in one statement each and their vectors are tombstoned
+    (compaction reclaims the space later); config.json keeps `survivors`.
+    Returns the number of images removed.
+    """
+    with WRITE_LOCK:
+        return _drop_roots(list(roots), list(survivors), store_dir)
+
+def _drop_roots(roots, survivors, store_dir):
+    _ensure_log_handler(store_dir)
+    cfg = _load_cfg(store_dir)
+    con = ensure_db(os.path.join(store_dir, "meta.sqlite"), analyze=False)
+    try:
+        migrate_store(store_dir, con)
+        marks = ",".join("?" * len(roots))
+        gone = np.fromiter((i for (i,) in con.execute(f"SELECT id FROM images WHERE root IN ({marks})", roots)),
+                           dtype=np.int64)
+        con.execute(f"DELETE FROM thumbs WHERE path IN (SELECT path FROM images WHERE root IN ({marks}))", roots)
+        con.execute(f"DELETE FROM images WHERE root IN ({marks})", roots)
+        for r in roots:
+            # the root's directory listings (path range scan on the primary key)
+            pre = r.rstrip(os.sep) + os.sep
+            con.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+                        (r, pre, pre[:-1] + chr(ord(os.sep) + 1)))
+        # DB first: should we die before the manifest, the rows left live are orphans
+        # that the next build tombstones
+        con.commit()
+    except Exception:
+        try: con.rollback()
+        except Exception: pass
+        raise
+    finally:
+        try: con.close()
+        except Exception: pass
+
+    prev = read_manifest(store_dir)
+    if prev is not None and prev["segments"] and len(gone):
+        # rows, attrs and IVF lists stay as they are; only the tombstones change
+        ids, dead = load_ids(store_dir, prev), load_tombstones(store_dir, prev)
+        rows = rows_of(rows_by_id(ids, dead), gone)
+        dead[rows[rows >= 0]] = True
+        commit_manifest(store_dir, prev, prev["segments"], dead)
+
+    cfg["roots"] = survivors
+    _atomic_write_json(os.path.join(store_dir, "config.json"), cfg)
+    logger.info("Removed roots %s: deleted=%d", roots, len(gone))
+    return len(gone)
+
+def needs_compaction(store_dir, cfg=None) -> bool:
+    m = read_manifest(store_dir)
+    if not m or not m["segments"]:
+        return False
+    icfg = indexer_cfg(cfg if cfg is not None else _load_cfg(store_dir))
+    dead = load_tombstones(store_dir, m)
+    return (len(m["segments"]) > int(icfg["max_segments"])
+            or (dead.size > 0 and dead.mean() > float(icfg["max_dead_ratio"])))
+
+def compact_store(store_dir) -> bool:
+    """
+    Merge vector segments and drop tombstoned rows, then refresh the files aligned
+    with row order (attrs, IVF lists). Returns True if the store changed.
+    """
+    with WRITE_LOCK:
+        cfg = _load_cfg(store_dir)
+        if not needs_compaction(store_dir, cfg):
+            return False
+        _ensure_log_handler(store_dir)
+        t0 = time.time()
+        m = read_manifest(store_dir)
+        dead = load_tombstones(store_dir, m)
+        icfg = indexer_cfg(cfg)
+        # the oldest segment is usually the big one: leave it alone unless it is itself dirty
+        first = m["segments"][0]["rows"]
+        start = 1 if len(m["segments"]) > 1 and dead[:first].mean() <= float(icfg["max_dead_ratio"]) else 0
+        from core.ivf_index import index_cfg
+        segments, dead = merge_segments(store_dir, m, dead, start, index_cfg(cfg)["quantize"])
+        if not segments:
+            return False  # everything was deleted; the next build starts cold
+        commit_manifest(store_dir, m, segments, dead)
+
+        store = open_segments(store_dir)
+        from core.attrs import build_attrs
+        con = sqlite3.connect(os.path.join(store_dir, "meta.sqlite"), timeout=5.0)
+        try:
+            attrs = build_attrs(con, store["ids"])
+        finally:
+            con.close()
+        _write_attrs(store_dir, attrs)
+        _write_ann(store_dir, store["X"], cfg, n_keep=first if start == 1 else 0)
+        logger.info("Compacted %d segments into %d (%d rows) in %.1fs",
+                    len(m["segments"]), len(segments), store["X"].shape[0], time.time() - t0)
+        return True
 
 def build_index(roots, store_dir, model, preprocess, batch_size=64, device="cpu"):
-    return build_index_with_progress(
+    build_index_with_progress(
         roots=roots,
         store_dir=store_dir,
         model=model,
@@ -275,4 +944,6 @@ def build_index(roots, store_dir, model, preprocess, batch_size=64, device="cpu"
         progress_cb=None,
         batch_size=batch_size,
         device=device
-    )
\ No newline at end of file
+    )
+    # no server around to do it in the background
+    compact_store(store_dir)
\ No newline at end of file
@@ -2,16 +2,12 @@ import os
 import shutil
 import sqlite3
 from core.server import  STORE_DIR, THUMB_DIR
+from core.segments import wipe_store_files
+from core.thumbs import close_pack
 
 def _wipe_store():
-    # delete index artifacts + config
-    for name in ("index.faiss", "vectors.npy", "ids.npy", "config.json"):
-        p = os.path.join(STORE_DIR, name)
-        try:
-            if os.path.exists(p):
-                os.remove(p)
-        except Exception:
-            pass
+    # delete index artifacts (vector segments, derived files) + config
+    wipe_store_files(STORE_DIR)
 
     # clear DB rows (keep empty DB file so app doesn’t crash)
     db_path = os.path.join(STORE_DIR, "meta.sqlite")
@@ -20,11 +16,14 @@ def _wipe_store():
             with sqlite3.connect(db_path, check_same_thread=False, timeout=5.0) as con:
                 con.execute("PRAGMA busy_timeout=5000;")
                 con.execute("DELETE FROM images")
+                if con.execute("SELECT 1 FROM sqlite_master WHERE name='thumbs'").fetchone():
+                    con.execute("DELETE FROM thumbs")
                 con.commit()
     except Exception:
         pass
 
     # clear thumbnails directory
+    close_pack(THUMB_DIR)
     try:
         if os.path.isdir(THUMB_DIR):
             shutil.rmtree(THUMB_DIR, ignore_errors=True)
@@ -1,8 +1,9 @@
-import os, sqlite3, numpy as np
+import os, json, sqlite3, numpy as np
 # import faiss
-from PIL import Image
 
-from core.numpy_index import NumpyIndex
+from core.ivf_index import index_cfg, load_index
+from core.segments import migrate_store, open_segments
+from core.attrs import build_attrs, load_attrs
 
 # def load_store(store_dir):
 #     index = faiss.read_index(os.path.join(store_dir, "index.faiss"))
@@ -11,55 +12,97 @@ from core.numpy_index import NumpyIndex
 #     return index, ids, con
 
 def load_store(store_dir):
-    vecs_path = os.path.join(store_dir, "vectors.npy")
-    ids_path = os.path.join(store_dir, "ids.npy")
     db_path  = os.path.join(store_dir, "meta.sqlite")
 
-    if not (os.path.exists(vecs_path) and os.path.exists(ids_path) and os.path.exists(db_path)):
+    if not os.path.exists(db_path):
         raise RuntimeError("Store files missing. Rebuild index.")
 
-    X = np.load(vecs_path, mmap_mode="r")
-    index = NumpyIndex(X)
-    ids = np.load(ids_path, allow_pickle=True)
+    cfg_path = os.path.join(store_dir, "config.json")
+    cfg = json.load(open(cfg_path)) if os.path.exists(cfg_path) else {}
     con = sqlite3.connect(db_path)
-    return index, ids, con
+    migrate_store(store_dir, con)
+    seg = open_segments(store_dir, index_cfg(cfg)["quantize"])
+    index = load_index(store_dir, seg, cfg)
+    return index, seg["ids"], con
 
-def post_filter(rows, con, folder=None, orientation=None):
+def _paths_of(con, image_ids):
+    """{images.id: path} for the given ids (vector rows carry ids, the DB holds the strings)."""
+    image_ids = list({int(i) for i in image_ids})
+    out = {}
+    for s in range(0, len(image_ids), 500):
+        chunk = image_ids[s:s + 500]
+        out.update(con.execute(f"SELECT id, path FROM images WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+    return out
+
+def filter_mask(store_dir, ids, con, folder=None, orientation=None):
     if not folder and not orientation:
-        return rows
-    keep = []
-    q = "SELECT folder, orientation FROM images WHERE path=?"
-    cur = con.cursor()
-    for i, path, score in rows:
-        f, o = cur.execute(q, (path,)).fetchone()
-        if (folder is None or f==folder) and (orientation is None or o==orientation):
-            keep.append((i, path, score))
-    return keep
+        return None
+    attrs = load_attrs(store_dir, len(ids)) or build_attrs(con, ids)
+    return attrs.mask(folder=folder, orientation=orientation)
 
-def search_by_vector(index, ids, qvec, topk=20):
-    D, I = index.search(qvec.astype("float32"), topk*5)  # over-fetch a bit for later filters
+def search_by_vector(index, ids, con, qvec, topk=20, mask=None):
+    D, I = index.search(qvec.astype("float32"), topk, mask=mask)  # filters applied in the scan
+    rows = [int(idx) for idx in I[0] if idx != -1]
+    path_of = _paths_of(con, ids[rows])
     hits = []
     for score, idx in zip(D[0], I[0]):
-        if idx == -1: continue
-        hits.append((int(idx), ids[idx], float(score)))
+        if idx == -1 or int(ids[idx]) not in path_of: continue
+        hits.append((int(idx), path_of[int(ids[idx])], float(score)))
     return hits
 
 def search_text(store_dir, model, tokenizer, text, topk=20, folder=None, orientation=None, device="cpu"):
     from models import embed_texts
     qvec = embed_texts(model, tokenizer, [text], device=device)
     index, ids, con = load_store(store_dir)
-    hits = search_by_vector(index, ids, qvec, topk=topk)
-    hits = post_filter(hits, con, folder, orientation)
+    mask = filter_mask(store_dir, ids, con, folder, orientation)
+    hits = search_by_vector(index, ids, con, qvec, topk=topk, mask=mask)
     con.close()
     return hits[:topk]
 
 def search_image(store_dir, model, preprocess, image_path, topk=20, folder=None, orientation=None, device="cpu"):
     from models import embed_images
-    from PIL import Image
-    im = Image.open(image_path).convert("RGB")
+    from core.helpers.images import EMBED_SIDE, load_rgb
+    _, im = load_rgb(image_path, min_side=EMBED_SIDE)
     qvec = embed_images(model, [preprocess(im)], device=device)
     index, ids, con = load_store(store_dir)
-    hits = search_by_vector(index, ids, qvec, topk=topk)
-    hits = post_filter(hits, con, folder, orientation)
+    mask = filter_mask(store_dir, ids, con, folder, orientation)
+    hits = search_by_vector(index, ids, con, qvec, topk=topk, mask=mask)
     con.close()
     return hits[:topk]
+
+def search_batch(store_dir, model, preprocess, tokenizer, queries, topk=20, folder=None, orientation=None, device="cpu", batch_size=256):
+    """
+    Run many queries through one embedding pass per kind and one shared index scan.
+    A query naming an existing file is an image query, anything else is text.
+    Returns one hits list per query (empty for images that fail to load).
+    """
+    from models import embed_texts, embed_images
+    from core.helpers.images import EMBED_SIDE, load_rgb
+    index, ids, con = load_store(store_dir)
+    qvecs = np.zeros((len(queries), index.d), dtype=np.float32)
+    failed = set()
+
+    texts = [j for j, q in enumerate(queries) if not os.path.isfile(q)]
+    for s in range(0, len(texts), batch_size):
+        chunk = texts[s:s + batch_size]
+        qvecs[chunk] = embed_texts(model, tokenizer, [queries[j] for j in chunk], device=device)
+
+    images = [j for j, q in enumerate(queries) if os.path.isfile(q)]
+    for s in range(0, len(images), 64):
+        ok, tensors = [], []
+        for j in images[s:s + 64]:
+            try:
+                _, im = load_rgb(queries[j], min_side=EMBED_SIDE)
+                tensors.append(preprocess(im)); ok.append(j)
+            except Exception:
+                failed.add(j)
+        if tensors:
+            qvecs[ok] = embed_images(model, tensors, device=device)
+
+    mask = filter_mask(store_dir, ids, con, folder, orientation)
+    D, I = index.search(qvecs, topk, mask=mask)
+    path_of = _paths_of(con, ids[I[I != -1]])
+    con.close()
+    return [[] if j in failed else [(int(i), path_of[int(ids[i])], float(d))
+                                    for i, d in zip(I[j], D[j]) if i != -1 and int(ids[i]) in path_of]
+            for j in range(len(queries))]
@@ -0,0 +1,75 @@
+# compute.py
+# A small bounded executor for the CPU-heavy part of request handlers (image decode,
+# embedding, scoring, thumbnail encoding), so that work never runs on the event loop
+# and a burst of uploads queues up here instead of starving every other endpoint.
+import threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+# defaults for the "compute" block in config.json
+DEFAULT_COMPUTE_CFG = {
+    "workers": 2,               # handler jobs running at once
+    "max_queue": 32,            # jobs waiting beyond this are turned away (503)
+    "max_upload_mb": 32,        # query image bytes (/search_image, /search_batch)
+    "max_pixels": 50_000_000,   # decoded query image size, after JPEG draft downscaling
+}
+
+def compute_cfg(cfg):
+    out = dict(DEFAULT_COMPUTE_CFG)
+    out.update((cfg or {}).get("compute") or {})
+    return out
+
+class ComputeBusy(Exception):
+    """The compute queue is full."""
+
+class ComputePool:
+    """Thread pool with a concurrency limit, a bounded queue and queue-depth stats."""
+    def __init__(self, workers=2, max_queue=32):
+        self.workers, self.max_queue = max(1, int(workers)), int(max_queue)
+        self._ex = ThreadPoolExecutor(self.workers, thread_name_prefix="compute")
+        self._lock = threading.Lock()
+        self.queued = self.running = 0
+        self.peak_queued = 0
+        self.done = self.rejected = 0
+        self._wait = 0.0  # seconds jobs spent queued, for the average
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise ComputeBusy()
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+        t0 = time.perf_counter()
+
+        def job():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self._wait += time.perf_counter() - t0
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.done += 1
+        try:
+            return self._ex.submit(job)
+        except RuntimeError:  # shut down
+            with self._lock:
+                self.queued -= 1
+            raise
+
+    def run(self, fn, *args, **kwargs):
+        """Run on the pool and wait (from a threadpool handler)."""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def shutdown(self):
+        self._ex.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "workers": self.workers, "running": self.running, "queued": self.queued,
+            "peak_queued": self.peak_queued, "max_queue": self.max_queue,
+            "done": self.done, "rejected": self.rejected,
+            "avg_wait_ms": round(1000 * self._wait / self.done, 2) if self.done else None,
+        }
@@ -0,0 +1,98 @@
+# db_pool.py
+# Read-only connections to meta.sqlite for the server's request handlers. Each request
+# checks one out instead of sharing a single connection across FastAPI's threadpool;
+# the pool is loaded and swapped together with the index, so a reindex never leaves
+# handlers reading a DB that doesn't match the vectors they just scored.
+import queue, sqlite3, threading, time
+from urllib.parse import quote
+
+# defaults for the "db" block in config.json
+DEFAULT_DB_CFG = {
+    "readers": 4,       # pooled read-only connections
+    "mmap_mb": 256,     # PRAGMA mmap_size per connection
+    "cache_mb": 16,     # PRAGMA cache_size per connection
+    "timeout": 10.0,    # seconds a request waits for a free connection
+}
+
+def db_cfg(cfg):
+    out = dict(DEFAULT_DB_CFG)
+    out.update((cfg or {}).get("db") or {})
+    return out
+
+def open_reader(db_path, mmap_mb=256, cache_mb=16):
+    """One read-only connection (WAL lets it read while the indexer writes)."""
+    con = sqlite3.connect(f"file:{quote(db_path)}?mode=ro", uri=True, check_same_thread=False, timeout=5.0)
+    con.execute("PRAGMA busy_timeout=5000;")
+    con.execute("PRAGMA query_only=ON;")
+    con.execute(f"PRAGMA mmap_size={int(mmap_mb) << 20};")
+    con.execute(f"PRAGMA cache_size=-{int(cache_mb) << 10};")  # negative = KiB
+    return con
+
+class PoolClosed(Exception):
+    """The pool was closed (its store swapped out) while waiting for a connection."""
+
+class ReadPool:
+    """Fixed set of read-only connections, one checked out per request."""
+    def __init__(self, db_path, readers=4, mmap_mb=256, cache_mb=16, timeout=10.0):
+        self.size, self.timeout = max(1, int(readers)), float(timeout)
+        self._free = queue.LifoQueue()  # most recently used first: warmest page cache
+        for _ in range(self.size):
+            self._free.put(open_reader(db_path, mmap_mb, cache_mb))
+        self._lock = threading.Lock()
+        self._closed = False
+        self.checkouts = self.waited = self.timeouts = 0
+        self._wait = self._max_wait = 0.0
+
+    def acquire(self):
+        """Check a connection out; PoolClosed once the pool was swapped out, TimeoutError if none frees up."""
+        t0 = time.perf_counter()
+        try:
+            con = self._free.get_nowait()
+        except queue.Empty:
+            try:
+                con = self._free.get(timeout=self.timeout)
+            except queue.Empty:
+                with self._lock:
+                    self.timeouts += 1
+                raise TimeoutError("No free DB connection")
+            with self._lock:
+                self.waited += 1
+        if con is None:
+            self._free.put(None)  # leave the marker for other waiters
+            raise PoolClosed()
+        dt = time.perf_counter() - t0
+        with self._lock:
+            self.checkouts += 1
+            self._wait += dt
+            self._max_wait = max(self._max_wait, dt)
+        return con
+
+    def release(self, con):
+        if con.in_transaction:
+            con.rollback()  # don't pin an old WAL snapshot
+        with self._lock:
+            if not self._closed:
+                self._free.put(con)
+                return
+        con.close()
+
+    def close(self):
+        """Close idle connections now; ones checked out are closed when returned."""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                con = self._free.get_nowait()
+            except queue.Empty:
+                break
+            if con is not None:
+                con.close()
+        self._free.put(None)  # wakes anyone still waiting on this pool
+
+    def stats(self):
+        return {
+            "readers": self.size, "idle": self._free.qsize(), "checkouts": self.checkouts,
+            "waited": self.waited, "timeouts": self.timeouts,
+            "avg_wait_ms": round(1000 * self._wait / self.checkouts, 3) if self.checkouts else None,
+            "max_wait_ms": round(1000 * self._max_wait, 3),
+        }
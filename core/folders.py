@@ -0,0 +1,77 @@
+# folders.py
+# Image counts per (root, directory), kept in step with `images` by triggers so every
+# insert/delete (indexer, watcher, root removal) updates them in the same transaction.
+# The server loads the few hundred rows into a tree and answers /folders from memory.
+
+# directory part of subpath ('/'-separated, "" for files directly in the root); rtrim
+# with every non-separator character of the string strips the file name
+_DIR = "rtrim(rtrim(replace(coalesce({r}.subpath, ''), '\\', '/'), replace(replace(coalesce({r}.subpath, ''), '\\', '/'), '/', '')), '/')"
+
+def _inc(r):
+    return f"""INSERT INTO folder_stats(root, dir, n) VALUES(coalesce({r}.root, ''), {_DIR.format(r=r)}, 1)
+        ON CONFLICT(root, dir) DO UPDATE SET n = n + 1;"""
+
+def _dec(r):
+    where = f"root = coalesce({r}.root, '') AND dir = {_DIR.format(r=r)}"
+    return f"""UPDATE folder_stats SET n = n - 1 WHERE {where};
+        DELETE FROM folder_stats WHERE {where} AND n <= 0;"""
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS folder_stats(
+        root TEXT NOT NULL,
+        dir TEXT NOT NULL,          -- directory under root ('/'-separated, "" = the root itself)
+        n INT NOT NULL,             -- images directly in it
+        PRIMARY KEY(root, dir)
+    ) WITHOUT ROWID;""",
+    f"CREATE TRIGGER IF NOT EXISTS folder_stats_ins AFTER INSERT ON images BEGIN {_inc('NEW')} END;",
+    f"CREATE TRIGGER IF NOT EXISTS folder_stats_del AFTER DELETE ON images BEGIN {_dec('OLD')} END;",
+    f"""CREATE TRIGGER IF NOT EXISTS folder_stats_upd AFTER UPDATE OF root, subpath ON images
+        BEGIN {_dec('OLD')} {_inc('NEW')} END;""",
+)
+
+def ensure_folder_stats(con):
+    """Create the table + triggers; stores from before them are counted once here."""
+    fresh = con.execute("SELECT 1 FROM sqlite_master WHERE name='folder_stats'").fetchone() is None
+    for stmt in _SCHEMA:
+        con.execute(stmt)
+    if fresh:
+        con.execute(f"""INSERT INTO folder_stats(root, dir, n)
+            SELECT coalesce(i.root, ''), {_DIR.format(r='i')} AS d, COUNT(*) FROM images i GROUP BY 1, 2""")
+    con.commit()
+
+class FolderTree:
+    """Per-root directory counts; each directory's count includes everything below it."""
+    def __init__(self, rows):
+        self.roots = {}  # root -> [count, {name: [count, children]}]
+        for root, d, n in rows:
+            node = self.roots.setdefault(root, [0, {}])
+            node[0] += n
+            for part in (d.split("/") if d else ["(root)"]):
+                node = node[1].setdefault(part, [0, {}])
+                node[0] += n
+        self.total = sum(n for n, _ in self.roots.values())
+        self._responses = {}
+
+    @classmethod
+    def load(cls, con):
+        return cls(con.execute("SELECT root, dir, n FROM folder_stats"))
+
+    def response(self, depth=1):
+        """The /folders body, with `depth` directory levels under each root (cached per depth)."""
+        depth = max(1, int(depth))
+        out = self._responses.get(depth)
+        if out is None:
+            def level(children, d):
+                items = []
+                for name, (n, sub) in sorted(children.items(), key=lambda kv: -kv[1][0]):
+                    item = {"name": name, "count": n}
+                    if d > 1 and sub:
+                        item["folders"] = level(sub, d - 1)
+                    items.append(item)
+                return items
+            roots = sorted(self.roots.items(), key=lambda kv: -kv[1][0])
+            out = self._responses[depth] = {
+                "total_images": self.total,
+                "roots": [{"root": r, "count": n, "folders": level(sub, depth)} for r, (n, sub) in roots],
+            }
+        return out
@@ -1,6 +1,60 @@
-import os
+import os, io, json
+import numpy as np
 
 
+def _atomic_write(path, write_fn):
+    tmp = f"{path}.tmp"
+    write_fn(tmp)
+    os.replace(tmp, path)
+
+def _atomic_write_json(path, obj):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+def _atomic_save_npy(path, array, **kwargs):
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, array, **kwargs)
+    os.replace(tmp, path)
+
+def _append_npy(path, rows):
+    """
+    Append `rows` to a C-order .npy in place: the data lands after the existing rows
+    first and only then is the header's shape bumped, so an interrupted append leaves
+    the old array readable (trailing bytes past the header's shape are ignored and cut
+    off by the next append). Rewrites the file if the header can't be updated in place.
+    Returns the row count before the append.
+    """
+    from numpy.lib import format as npf
+    rows = np.ascontiguousarray(rows)
+    with open(path, "r+b") as f:
+        version = npf.read_magic(f)
+        read = npf.read_array_header_1_0 if version == (1, 0) else npf.read_array_header_2_0
+        shape, fortran, dtype = read(f)
+        data_off = f.tell()
+        if fortran or dtype != rows.dtype or tuple(shape[1:]) != rows.shape[1:]:
+            raise ValueError(f"Can't append {rows.dtype}{rows.shape} rows to {path}")
+        n = int(shape[0])
+        if not rows.shape[0]:
+            return n
+        head = io.BytesIO()
+        write = npf.write_array_header_1_0 if version == (1, 0) else npf.write_array_header_2_0
+        write(head, {"descr": npf.dtype_to_descr(dtype), "fortran_order": False,
+                     "shape": (n + rows.shape[0], *shape[1:])})
+        if head.tell() == data_off:
+            end = data_off + n * dtype.itemsize * int(np.prod(shape[1:], dtype=np.int64))
+            f.truncate(end)
+            f.seek(end)
+            f.write(rows.tobytes())
+            f.flush()
+            f.seek(0)
+            f.write(head.getvalue())
+            return n
+    _atomic_save_npy(path, np.concatenate([np.load(path), rows]))
+    return n
+
 def _norm_path(p: str) -> str:
     # normalize for comparisons: expand ~, resolve symlinks, absolutize, collapse separators
     p = os.path.expanduser(p)
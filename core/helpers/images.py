@@ -0,0 +1,61 @@
+from PIL import Image, ImageOps
+
+# CLIP (ViT-B-32) input resolution; decoding much beyond this is wasted work
+EMBED_SIDE = 224
+
+class ImageTooLarge(ValueError):
+    pass
+
+def _flatten(im):
+    # If transparent, composite over white so background isn't black
+    if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+        im = im.convert("RGBA")
+        bg = Image.new("RGBA", im.size, (255, 255, 255, 255))
+        return Image.alpha_composite(bg, im).convert("RGB")
+    return im.convert("RGB")
+
+def load_rgb(src, min_side=None, exif=False, flatten_alpha=False, max_pixels=None):
+    """
+    Decode `src` (path or file object) to RGB without paying for pixels we throw away.
+    With `min_side`, JPEGs are decoded at 1/2..1/8 scale (PIL draft) and other formats
+    are box-reduced after decode, keeping the shorter side >= min_side.
+    With `max_pixels`, images that would still decode bigger than that raise
+    ImageTooLarge before any pixel data is read.
+    Returns ((orig_width, orig_height), image).
+    """
+    with Image.open(src) as im:
+        size = im.size
+        if min_side:
+            # JPEG only: DCT scaling; a no-op for other formats
+            im.draft("RGB", (min_side, min_side))
+        if max_pixels and im.size[0] * im.size[1] > max_pixels:
+            raise ImageTooLarge(f"{size[0]}x{size[1]} image is over the {max_pixels} pixel limit")
+        if exif:
+            # Honor EXIF orientation for JPEGs, etc.
+            im = ImageOps.exif_transpose(im)
+        out = _flatten(im) if flatten_alpha else im.convert("RGB")
+    if min_side:
+        factor = min(out.size) // min_side
+        if factor >= 2:
+            out = out.reduce(factor)
+    return size, out
+
+def load_rgb_and_thumb(src, embed_side, thumb_side):
+    """
+    One decode feeding both the embedder and a thumbnail, as load_rgb(min_side=embed_side)
+    and load_rgb(min_side=thumb_side, exif=True, flatten_alpha=True) would.
+    Returns ((orig_width, orig_height), embed image, thumb image).
+    """
+    with Image.open(src) as im:
+        size = im.size
+        im.draft("RGB", (max(embed_side, thumb_side),) * 2)
+        im.load()
+        thumb = _flatten(ImageOps.exif_transpose(im))
+        out = im.convert("RGB")
+    factor = min(out.size) // embed_side
+    if factor >= 2:
+        out = out.reduce(factor)
+    factor = min(thumb.size) // thumb_side
+    if factor >= 2:
+        thumb = thumb.reduce(factor)
+    return size, out, thumb
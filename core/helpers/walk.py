@@ -0,0 +1,99 @@
+import os, stat, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+IMAGE_EXTS = {".jpg",".jpeg",".png",".webp",".bmp",".tiff",".tif"}
+
+def _is_image(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTS
+
+# a directory modified this recently may still change within the same mtime tick;
+# don't trust it on the next scan
+RACY_SECONDS = 2.0
+
+class DirWalker:
+    """
+    Parallel os.scandir walk of `roots`, yielding (root, path, mtime, size) for image
+    files as soon as their directory has been listed.
+
+    `cache` maps dir -> [mtime, subdir names, image count] from a previous walk and
+    `known` maps dir -> the image paths found in it then. A directory whose mtime
+    still matches is not listed again (no entries were added, removed or renamed in
+    it): its subdirectories come from the cache, its `known` files are stat'ed
+    directly (so in-place edits are still seen) and it lands in `trusted`.
+    After iterating, `listing` holds the cache to persist for the next walk.
+    """
+    def __init__(self, roots, workers=8, cache=None, known=None):
+        self.roots = list(roots)
+        self.workers = max(1, int(workers))
+        self.cache = cache or {}
+        self.known = known or {}
+        self.trusted = set()
+        self.listed = set()
+        self.listing = {}
+
+    def _list(self, d, mtime):
+        """(image files, (subdir, mtime) pairs, listing skipped)"""
+        hit = self.cache.get(d)
+        if hit is not None and hit[0] == mtime:
+            files, subs = [], []
+            for name in hit[1]:
+                try:
+                    st = os.stat(os.path.join(d, name), follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    subs.append((name, st.st_mtime))
+            for path in self.known.get(d, ()):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, st.st_mtime, st.st_size))
+            return files, subs, True
+        files, subs = [], []
+        with os.scandir(d) as it:
+            for e in it:
+                try:
+                    # like os.walk: symlinked files count, symlinked dirs are not descended
+                    if e.is_dir(follow_symlinks=False):
+                        subs.append((e.name, e.stat(follow_symlinks=False).st_mtime))
+                    elif e.is_file() and _is_image(e.name):
+                        st = e.stat()
+                        files.append((e.path, st.st_mtime, st.st_size))
+                except OSError:
+                    continue
+        return files, subs, False
+
+    def __iter__(self):
+        t0 = time.time()
+        pool = ThreadPoolExecutor(self.workers)
+        pending = {}
+        def _submit(root, d, mtime):
+            pending[pool.submit(self._list, d, mtime)] = (root, d, mtime)
+        try:
+            for root in self.roots:
+                try:
+                    _submit(root, root, os.stat(root).st_mtime)
+                except OSError:
+                    continue
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    root, d, mtime = pending.pop(fut)
+                    try:
+                        files, subs, cached = fut.result()
+                    except OSError:
+                        continue  # unreadable directory: skipped, as os.walk does
+                    for name, sub_mtime in subs:
+                        _submit(root, os.path.join(d, name), sub_mtime)
+                    if cached:
+                        self.trusted.add(d)
+                        self.listing[d] = self.cache[d]
+                    else:
+                        self.listed.add(d)
+                        if mtime < t0 - RACY_SECONDS:
+                            self.listing[d] = [mtime, [name for name, _ in subs], len(files)]
+                    for path, m, size in files:
+                        yield root, path, m, size
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,189 @@
+import os
+import numpy as np
+
+from core.numpy_index import NumpyIndex, _empty, _stack, auto_threads
+
+# persisted in STORE_DIR next to segments.json; rows in ivf_list_ids are grouped by list
+IVF_FILES = ("ivf_centroids.npy", "ivf_offsets.npy", "ivf_list_ids.npy")
+# list of each row appended after the grouped ones (rows offsets[-1]..N-1); folded
+# into the grouped lists once it is TAIL_RATIO of the store
+IVF_TAIL = "ivf_tail.npy"
+TAIL_RATIO = 0.25
+
+# defaults for the "index" block in config.json
+DEFAULT_INDEX_CFG = {
+    "type": "flat",      # flat|ivf
+    "nlist": 0,          # 0 = auto (~4*sqrt(N))
+    "nprobe": 16,        # lists scanned per query: higher = better recall, slower
+    "min_rows": 20000,   # below this a flat scan is faster than probing
+    "quantize": "none",  # none|fp16|int8 scoring copy (segments/seg_*.q.npy); fp16 saves RAM but scores ~8x slower than float32
+    "rerank": 0,         # with quantize: re-score top k*rerank with float32 (0 = off)
+    "threads": 0,        # scan threads for large stores (0 = auto)
+    "block": 16384,      # rows scored per step; bounds scratch memory per thread
+}
+
+def index_cfg(cfg: dict | None) -> dict:
+    out = dict(DEFAULT_INDEX_CFG)
+    out.update((cfg or {}).get("index") or {})
+    return out
+
+def _auto_nlist(n: int) -> int:
+    return max(1, min(n, int(4 * np.sqrt(n))))
+
+def _assign(X, C):
+    """Nearest centroid (by inner product) for every row, scanned in blocks."""
+    labels = np.empty(X.shape[0], dtype=np.int64)
+    block = max(1024, (1 << 24) // max(1, C.shape[0]))  # ~64 MB of scores per block
+    for s in range(0, X.shape[0], block):
+        blk = np.asarray(X[s:s + block], dtype=np.float32)
+        labels[s:s + block] = np.argmax(blk @ C.T, axis=1)
+    return labels
+
+def train_ivf(X, nlist: int = 0, niter: int = 10, per_list: int = 64, max_sample: int = 262144, seed: int = 0):
+    """
+    Spherical k-means coarse quantizer over a normalized (N, D) matrix.
+    Trains on a sample (`per_list` points per list, capped), then assigns every row.
+    Returns (centroids [nlist,D], offsets [nlist+1], list_ids [N]).
+    """
+    n = int(X.shape[0])
+    nlist = int(nlist) or _auto_nlist(n)
+    nlist = max(1, min(nlist, n))
+    rng = np.random.default_rng(seed)
+
+    m = min(n, nlist * per_list, max(max_sample, nlist))
+    sample_rows = np.sort(rng.choice(n, size=m, replace=False))
+    S = np.asarray(X[sample_rows], dtype=np.float32)
+    C = S[rng.choice(m, size=nlist, replace=False)].copy()
+
+    for _ in range(niter):
+        labels = _assign(S, C)
+        counts = np.bincount(labels, minlength=nlist)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(C)
+        live = counts > 0
+        sums[live] = np.add.reduceat(S[np.argsort(labels, kind="stable")], starts[live], axis=0)
+        empty = ~live
+        if empty.any():
+            # re-seed dead lists from random sample points
+            sums[empty] = S[rng.choice(m, size=int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        C = (sums / np.maximum(norms, 1e-12)).astype(np.float32)
+
+    offsets, list_ids = _lists(_assign(X, C), nlist)
+    return C, offsets, list_ids
+
+def _lists(labels, nlist):
+    list_ids = np.argsort(labels, kind="stable").astype(np.int64)
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=nlist), out=offsets[1:])
+    return offsets, list_ids
+
+def extend_ivf(X, C, offsets, list_ids, n_keep: int, tail=None):
+    """
+    Reuse trained centroids: rows < n_keep keep their old list (grouped or in the
+    `tail`), rows >= n_keep (appended or renumbered by a merge) are assigned fresh.
+    """
+    nlist = int(C.shape[0])
+    labels = np.empty(X.shape[0], dtype=np.int64)
+    old = np.asarray(list_ids)
+    old_labels = np.repeat(np.arange(nlist), np.diff(offsets))
+    keep = old < n_keep
+    labels[old[keep]] = old_labels[keep]
+    if tail is not None and len(tail):
+        trows = int(offsets[-1]) + np.arange(len(tail))
+        keep = trows < n_keep
+        labels[trows[keep]] = np.asarray(tail)[keep]
+    labels[n_keep:] = _assign(X[n_keep:], C)
+    return _lists(labels, nlist)
+
+class IVFIndex:
+    """Inverted-file ANN index with the same search contract as NumpyIndex.
+    Candidate rows are scored by the wrapped flat index (so quantization/re-rank apply)."""
+    mode = "ivf"
+
+    def __init__(self, flat: NumpyIndex, centroids: np.ndarray, offsets: np.ndarray,
+                 list_ids: np.ndarray, nprobe: int = 16, tail: np.ndarray | None = None):
+        self._flat = flat
+        self._C = np.asarray(centroids, dtype=np.float32)
+        self._offsets = offsets
+        self._list_ids = list_ids
+        # rows appended since the lists were grouped, grouped here (the tail is small)
+        tail = np.empty(0, dtype=np.int64) if tail is None else np.asarray(tail, dtype=np.int64)
+        self._tail_offsets, tail_rows = _lists(tail, self._C.shape[0])
+        self._tail_rows = tail_rows + int(offsets[-1])
+        self.d = flat.d
+        self.nprobe = max(1, int(nprobe))
+
+    @property
+    def ntotal(self) -> int:
+        return self._flat.ntotal
+
+    @property
+    def nlive(self) -> int:
+        return self._flat.nlive
+
+    @property
+    def nlist(self) -> int:
+        return int(self._C.shape[0])
+
+    def reconstruct(self, rows) -> np.ndarray:
+        return self._flat.reconstruct(rows)
+
+    def _candidates(self, q: np.ndarray, k: int, mask: np.ndarray | None = None) -> np.ndarray:
+        order = np.argsort(-(self._C @ q))
+        # probe at least nprobe lists, more while they hold fewer than k (allowed) rows
+        chunks, found = [], 0
+        for n_probed, c in enumerate(order):
+            if n_probed >= self.nprobe and found >= k:
+                break
+            rows = np.asarray(self._list_ids[self._offsets[c]:self._offsets[c + 1]])
+            if self._tail_rows.size:
+                rows = np.concatenate([rows, self._tail_rows[self._tail_offsets[c]:self._tail_offsets[c + 1]]])
+            if mask is not None:
+                rows = rows[mask[rows]]
+            chunks.append(rows)
+            found += rows.shape[0]
+        rows = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+        rows.sort()  # ascending row order keeps mmap reads sequential
+        return rows
+
+    def search(self, qvec: np.ndarray, k: int, mask: np.ndarray | None = None):
+        Q = np.atleast_2d(qvec.astype(np.float32, copy=False))
+        if self.ntotal == 0 or k <= 0:
+            return _empty(Q.shape[0])
+        if Q.shape[0] > 1:
+            # every query probes its own lists; no shared pass to batch
+            return _stack([self.search(q[None], k, mask) for q in Q])
+        q = Q[0]
+        mask = self._flat.live_mask(mask)
+        if mask is not None:
+            allowed = np.flatnonzero(mask)
+            # a selective filter leaves fewer rows than the probed lists would hold:
+            # score them all exactly instead of walking most of the lists
+            if allowed.shape[0] <= self.nprobe * self.ntotal / max(self.nlist, 1):
+                return self._flat.search_rows(q, allowed, k)
+        rows = self._candidates(q, k, mask)
+        return self._flat.search_rows(q, rows, k)
+
+def load_index(store_dir: str, store: dict, cfg: dict | None = None):
+    """Open the index configured in config.json over an open_segments() store,
+    falling back to a flat scan."""
+    icfg = index_cfg(cfg)
+    X = store["X"]
+    flat = NumpyIndex(X, store["codes"], store["scales"], rerank=icfg["rerank"], dead=store["dead"],
+                      threads=int(icfg["threads"]) or auto_threads(), block=icfg["block"])
+    if icfg["type"] != "ivf":
+        return flat
+    paths = [os.path.join(store_dir, name) for name in IVF_FILES]
+    if not all(os.path.exists(p) for p in paths):
+        return flat
+    C = np.load(paths[0])
+    offsets = np.load(paths[1])
+    list_ids = np.load(paths[2], mmap_mode="r")
+    tail_path = os.path.join(store_dir, IVF_TAIL)
+    tail = np.load(tail_path) if os.path.exists(tail_path) else np.empty(0, dtype=np.int64)
+    # stale lists (e.g. written by an older build) -> exact search
+    if (C.shape[1] != X.shape[1] or list_ids.shape[0] != int(offsets[-1])
+            or int(offsets[-1]) + tail.shape[0] != X.shape[0]):
+        return flat
+    return IVFIndex(flat, C, offsets, list_ids, nprobe=icfg["nprobe"], tail=tail)
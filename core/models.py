@@ -1,4 +1,6 @@
-import os, torch, open_clip
+import os, threading, torch, open_clip
+import numpy as np
+from collections import OrderedDict
 
 def load_model(device="cpu", name="ViT-B-32", ckpt="laion2b_s34b_b79k"):
     """
@@ -30,19 +32,21 @@ def load_model(device="cpu", name="ViT-B-32", ckpt="laion2b_s34b_b79k"):
 
     tokenizer = open_clip.get_tokenizer(name)
     model.eval()
+    # identifies the weights for caches keyed on model output
+    model.refsearch_id = f"{name}/{os.path.basename(pretrained) if model_dir else ckpt}"
     return model, preprocess, tokenizer
 
 @torch.no_grad()
 def embed_images(model, images, device="cpu"):
-    # images: list of preprocessed tensors [3,H,W]
+    # images: list of preprocessed tensors (or float arrays) [3,H,W]
     import torch.nn.functional as F
-    batch = torch.stack(images).to(device)
+    batch = torch.stack([torch.as_tensor(im) for im in images]).to(device)
     feats = model.encode_image(batch)
     feats = F.normalize(feats, dim=-1)
     return feats.cpu().numpy()
 
 @torch.no_grad()
-def embed_texts(model, tokenizer, texts, device="cpu"):
+def _encode_texts(model, tokenizer, texts, device):
     import torch.nn.functional as F
     toks = tokenizer(texts)
     if hasattr(toks, "to"):
@@ -50,3 +54,123 @@ def embed_texts(model, tokenizer, texts, device="cpu"):
     feats = model.encode_text(toks)
     feats = F.normalize(feats, dim=-1)
     return feats.cpu().numpy()
+
+def model_id(model):
+    return getattr(model, "refsearch_id", type(model).__name__)
+
+def normalize_query(text):
+    # the CLIP tokenizer lowercases and collapses whitespace itself, so these embed identically
+    return " ".join(str(text).split()).lower()
+
+class TextEmbeddingCache:
+    """
+    LRU of (model id, normalized query) -> text embedding, bounded by entry count and
+    bytes. Optionally persisted to an .npz so warm queries survive a restart.
+    """
+    def __init__(self, max_entries=2048, max_bytes=16 << 20, path=None, save_every=32):
+        self.max_entries, self.max_bytes = int(max_entries), int(max_bytes)
+        self.path, self.save_every = path, int(save_every)
+        self._d = OrderedDict()
+        self._bytes = 0
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def _size(key, vec):
+        return vec.nbytes + len(key[0]) + len(key[1])
+
+    def get(self, key):
+        with self._lock:
+            vec = self._d.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._d.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def peek(self, key):
+        """Like get(), without touching recency or hit stats (bulk callers)."""
+        with self._lock:
+            return self._d.get(key)
+
+    def put(self, key, vec):
+        vec = np.array(vec, dtype=np.float32)  # own copy; callers may mutate theirs
+        with self._lock:
+            old = self._d.pop(key, None)
+            if old is not None:
+                self._bytes -= self._size(key, old)
+            self._d[key] = vec
+            self._bytes += self._size(key, vec)
+            while self._d and (len(self._d) > self.max_entries or self._bytes > self.max_bytes):
+                k, v = self._d.popitem(last=False)
+                self._bytes -= self._size(k, v)
+                self.evictions += 1
+            self._unsaved += 1
+            due = self.path and self.save_every > 0 and self._unsaved >= self.save_every
+        if due:
+            self.save()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._d), "bytes": self._bytes,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+    def save(self):
+        if not self.path:
+            return
+        from core.helpers.helpers import _atomic_write
+        with self._lock:
+            keys = list(self._d)
+            vecs = np.stack(list(self._d.values())) if keys else np.empty((0, 0), np.float32)
+            self._unsaved = 0
+        models = np.array([k[0] for k in keys], dtype=str)
+        texts = np.array([k[1] for k in keys], dtype=str)
+        def _write(tmp):
+            with open(tmp, "wb") as f:
+                np.savez(f, models=models, texts=texts, vecs=vecs)
+        try:
+            _atomic_write(self.path, _write)
+        except OSError:
+            pass  # only a cache
+
+    def load(self, model):
+        """Restore persisted entries for `model`; anything from other weights is dropped."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as z:
+                models, texts, vecs = z["models"], z["texts"], z["vecs"]
+        except Exception:
+            return
+        mid = model_id(model)
+        path, self.path = self.path, None  # no write-back while restoring
+        try:
+            for m, t, v in zip(models, texts, vecs):  # oldest first, so LRU order survives
+                if str(m) == mid:
+                    self.put((mid, str(t)), v)
+        finally:
+            self.path, self._unsaved = path, 0
+
+def embed_texts(model, tokenizer, texts, device="cpu", cache=None, update_cache=True):
+    """
+    Normalized text embeddings [N, D]; with `cache`, only unseen queries hit the text tower.
+    `update_cache=False` only reads it (batch jobs mustn't evict the UI's queries).
+    """
+    if cache is None:
+        return _encode_texts(model, tokenizer, texts, device)
+    mid = model_id(model)
+    keys = [(mid, normalize_query(t)) for t in texts]
+    found = [(cache.get if update_cache else cache.peek)(k) for k in keys]
+    todo = sorted({k[1] for k, v in zip(keys, found) if v is None})
+    if todo:
+        feats = _encode_texts(model, tokenizer, todo, device)
+        fresh = dict(zip(todo, feats))
+        for t, v in (fresh.items() if update_cache else ()):
+            cache.put((mid, t), v)
+        found = [v if v is not None else fresh[k[1]] for k, v in zip(keys, found)]
+    return np.stack(found)
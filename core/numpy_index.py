@@ -1,26 +1,209 @@
+import os, threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# compact scoring copy of the float32 vectors (which stay on disk for exact
+# re-ranking); each segment keeps its own. These top-level names are only
+# left by pre-segment stores and are removed when they are migrated
+QUANT_FILES = ("vectors_q.npy", "vectors_scale.npy")
+# numpy has no fast half-precision matmul, so codes are widened to float32 block by
+# block before scoring: cheap for int8, but fp16 -> float32 conversion is slow enough
+# that an fp16 scan of vectors already in RAM is several times slower than float32.
+# fp16 only pays off when memory (not CPU) is the limit.
+QUANT_DTYPES = {"fp16": np.float16, "int8": np.int8}
+
+def quantize(X: np.ndarray, kind: str, block: int = 65536):
+    """Return (codes, scales) for `kind` (fp16|int8); scales is None for fp16."""
+    if kind == "fp16":
+        return X.astype(np.float16), None
+    if kind != "int8":
+        raise ValueError(f"Unknown quantization: {kind}")
+    # symmetric per-vector scale: x ~= codes * scale
+    scales = np.maximum(np.abs(X).max(axis=1) / 127.0, 1e-12).astype(np.float32)
+    codes = np.empty(X.shape, dtype=np.int8)
+    for s in range(0, X.shape[0], block):
+        codes[s:s + block] = np.rint(X[s:s + block] / scales[s:s + block, None])
+    return codes, scales
+
+def _empty(nq: int = 1):
+    return (np.empty((nq, 0), dtype=np.float32),
+            np.empty((nq, 0), dtype=np.int64))
+
+def _stack(results):
+    """Per-query (D[1, m], I[1, m]) results -> (Q, max m), padded FAISS-style with -inf / -1."""
+    width = max((I.shape[1] for _, I in results), default=0)
+    D = np.full((len(results), width), -np.inf, dtype=np.float32)
+    I = np.full((len(results), width), -1, dtype=np.int64)
+    for r, (d, i) in enumerate(results):
+        D[r, :d.shape[1]] = d[0]
+        I[r, :i.shape[1]] = i[0]
+    return D, I
+
+def _merge(best_s, best_i, S, I, k: int):
+    """Fold a (q, m) score block into a running (q, <=k) top-k (unordered)."""
+    S = np.concatenate([best_s, S], axis=1)
+    I = np.concatenate([best_i, I], axis=1)
+    if S.shape[1] > k:
+        part = np.argpartition(-S, k - 1, axis=1)[:, :k]
+        S, I = np.take_along_axis(S, part, 1), np.take_along_axis(I, part, 1)
+    return S, I
+
+def auto_threads() -> int:
+    return max(1, min(8, os.cpu_count() or 1))
+
+# scoring threads shared by every index (and request); matmul releases the GIL
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def _pool(n: int):
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None or _POOL._max_workers < n:
+            _POOL = ThreadPoolExecutor(n, thread_name_prefix="scan")
+        return _POOL
+
+def _topk(sims: np.ndarray, rows, k: int):
+    """Best k of `sims` (descending); `rows` maps positions back to matrix rows (None = identity)."""
+    k = min(int(k), sims.shape[0])
+    if k <= 0:
+        return _empty()
+    part_idx = np.argpartition(-sims, k - 1)[:k]
+    part_scores = sims[part_idx]
+    order = np.argsort(-part_scores)
+    order = order[np.isfinite(part_scores[order])]  # masked-out rows never surface
+    idx = part_idx[order]
+    if rows is not None:
+        idx = rows[idx]
+    I = idx.astype(np.int64, copy=False).reshape(1, -1)
+    D = part_scores[order].astype(np.float32, copy=False).reshape(1, -1)
+    return D, I
 
 class NumpyIndex:
     """FAISS-like wrapper over a normalized (N, D) float32 matrix."""
-    def __init__(self, X: np.ndarray):
+    mode = "numpy"
+
+    # masks allowing more than this fraction of rows are scored in full and then
+    # knocked out; sparser ones gather only the allowed rows
+    DENSE_MASK = 0.5
+    # rows dequantized/scored per step; bounds the float32 scratch to BLOCK x D
+    BLOCK = 16384
+    # queries scored together in a batch; bounds the score scratch to QBLOCK x BLOCK
+    QBLOCK = 256
+    # ranges smaller than this are scanned on the calling thread
+    MIN_PARALLEL_ROWS = 65536
+
+    def __init__(self, X: np.ndarray, codes: np.ndarray | None = None,
+                 scales: np.ndarray | None = None, rerank: int = 0,
+                 dead: np.ndarray | None = None, threads: int = 1, block: int = 0):
         assert X.dtype == np.float32
-        self._X = X
+        self._X = X              # ndarray/mmap or a SegmentedMatrix
+        self._codes = codes      # optional fp16/int8 copy used for scoring
+        self._scales = scales    # per-row scale for int8 codes
+        self.rerank = int(rerank)  # re-score top k*rerank candidates with float32 X
         self.d = int(X.shape[1])
+        self.threads = max(1, int(threads))  # scan workers for large stores
+        self.block = int(block) or self.BLOCK
+        # tombstoned rows never match; None when nothing is deleted
+        self._alive = None if dead is None or not dead.any() else ~dead
 
     @property
     def ntotal(self) -> int:
+        """Rows in the matrix (including tombstoned ones); ids[] is aligned to this."""
         return int(self._X.shape[0])
 
-    def search(self, qvec: np.ndarray, k: int):
+    @property
+    def nlive(self) -> int:
+        return self.ntotal if self._alive is None else int(self._alive.sum())
+
+    def reconstruct(self, rows) -> np.ndarray:
+        """Stored float32 vectors for the given rows (FAISS naming)."""
+        return np.asarray(self._X[np.asarray(rows, dtype=np.int64)], dtype=np.float32)
+
+    def live_mask(self, mask: np.ndarray | None):
+        """Fold tombstones into a caller mask (None = everything allowed)."""
+        if self._alive is None:
+            return mask
+        return self._alive if mask is None else (mask & self._alive)
+
+    def search_rows(self, q: np.ndarray, rows: np.ndarray, k: int):
+        """Top-k of a single query (D,) restricted to the given row ids."""
+        return self._search_many(q.reshape(1, -1), k, rows=rows)
+
+    def _scan_range(self, Q: np.ndarray, k: int, start: int, stop: int,
+                    rows: np.ndarray | None, mask: np.ndarray | None):
+        """Running top-k of Q over positions [start, stop) of the matrix (or of `rows`)."""
+        M = self._X if self._codes is None else self._codes
+        # keep the (q, step) score block around 16 MB however many queries there are
+        step = max(1024, min(self.block, (1 << 22) // Q.shape[0]))
+        best_s = np.empty((Q.shape[0], 0), dtype=np.float32)
+        best_i = np.empty((Q.shape[0], 0), dtype=np.int64)
+        # codes are widened into one reused buffer instead of a fresh array per block
+        buf = None if M.dtype == np.float32 else np.empty((min(step, stop - start), self.d), dtype=np.float32)
+        for s in range(start, stop, step):
+            e = min(s + step, stop)
+            idx = np.arange(s, e) if rows is None else rows[s:e]
+            blk = M[s:e] if rows is None else M[idx]
+            if buf is not None:
+                np.copyto(buf[:e - s], blk)
+                blk = buf[:e - s]
+            S = Q @ blk.T
+            if self._scales is not None:
+                S *= self._scales[idx]
+            if mask is not None:
+                S[:, ~mask[s:e]] = -np.inf
+            best_s, best_i = _merge(best_s, best_i, S, np.broadcast_to(idx, S.shape), k)
+        return best_s, best_i
+
+    def _scan_topk(self, Q: np.ndarray, k: int, rows: np.ndarray | None = None,
+                   mask: np.ndarray | None = None):
+        """
+        Blocked scan of a (q, D) batch over every row (or just `rows`): score blocks are
+        cut down to k as they go, so scratch memory doesn't grow with N. Large scans
+        are split into contiguous ranges, one per thread, and their top-k merged.
+        Returns (scores, matrix rows), both (q, <=k), best first; -inf marks masked slots.
+        """
+        n = self.ntotal if rows is None else rows.shape[0]
+        workers = min(self.threads, n // self.MIN_PARALLEL_ROWS)
+        if workers <= 1:
+            best_s, best_i = self._scan_range(Q, k, 0, n, rows, mask)
+        else:
+            per = -(-n // workers)
+            per = -(-per // self.block) * self.block  # whole blocks per range
+            futs = [_pool(self.threads).submit(self._scan_range, Q, k, s, min(s + per, n), rows, mask)
+                    for s in range(0, n, per)]
+            best_s = np.empty((Q.shape[0], 0), dtype=np.float32)
+            best_i = np.empty((Q.shape[0], 0), dtype=np.int64)
+            for f in futs:
+                best_s, best_i = _merge(best_s, best_i, *f.result(), k)
+        order = np.argsort(-best_s, axis=1)
+        return np.take_along_axis(best_s, order, 1), np.take_along_axis(best_i, order, 1)
+
+    def _search_many(self, Q: np.ndarray, k: int, rows: np.ndarray | None = None,
+                     mask: np.ndarray | None = None):
+        rerank = self._codes is not None and self.rerank > 0
+        kk = k * self.rerank if rerank else k
+        out = []
+        for s in range(0, Q.shape[0], self.QBLOCK):
+            D, I = self._scan_topk(Q[s:s + self.QBLOCK], kk, rows, mask)
+            for q, d, i in zip(Q[s:s + self.QBLOCK], D, I):
+                i = i[np.isfinite(d)]
+                if rerank:
+                    # approximate shortlist from the codes, exact order from float32 rows
+                    cand = np.sort(i)
+                    out.append(_topk(self._X[cand] @ q, cand, k))
+                else:
+                    out.append((d[:i.shape[0]].reshape(1, -1), i.reshape(1, -1)))
+        return _stack(out)
+
+    def search(self, qvec: np.ndarray, k: int, mask: np.ndarray | None = None):
+        """
+        Top-k by inner product for each row of qvec (Q, D). `mask` (bool[N]) restricts
+        scoring to allowed rows. Several queries share one blocked pass over the matrix.
+        """
+        Q = np.atleast_2d(qvec.astype(np.float32, copy=False))
         if self.ntotal == 0 or k <= 0:
-            return (np.empty((1, 0), dtype=np.float32),
-                    np.empty((1, 0), dtype=np.int64))
-        q = qvec.astype(np.float32, copy=False)
-        sims = (q @ self._X.T)[0]
-        k = min(int(k), sims.shape[0])
-        part_idx = np.argpartition(-sims, k - 1)[:k]
-        part_scores = sims[part_idx]
-        order = np.argsort(-part_scores)
-        I = part_idx[order].astype(np.int64, copy=False).reshape(1, -1)
-        D = part_scores[order].astype(np.float32, copy=False).reshape(1, -1)
-        return D, I
\ No newline at end of file
+            return _empty(Q.shape[0])
+        mask = self.live_mask(mask)
+        if mask is not None and np.count_nonzero(mask) <= self.DENSE_MASK * self.ntotal:
+            return self._search_many(Q, k, rows=np.flatnonzero(mask))  # sparse filter: gather allowed rows only
+        return self._search_many(Q, k, mask=mask)
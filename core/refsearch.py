@@ -1,7 +1,7 @@
-import typer, os, platform, subprocess
+import typer, os, json, platform, subprocess
 from models import load_model
 from core.commands.indexer import build_index
-from core.commands.searcher import search_text, search_image
+from core.commands.searcher import search_text, search_image, search_batch
 import time
 
 app = typer.Typer(add_completion=False)
@@ -55,5 +55,30 @@ def search(
     if open_ > 0:
         open_paths([p for _, p, _ in hits[:open_]])
 
+@app.command("search-batch")
+def search_batch_cmd(
+    queries: str = typer.Argument(..., help="File with one query per line: text, or a path to an image"),
+    topk: int = typer.Option(20, help="Number of results per query"),
+    folder: str = typer.Option(None, help="Filter: folder equals"),
+    orientation: str = typer.Option(None, help="Filter: landscape|portrait|square"),
+    store: str = typer.Option("store", help="Index store dir"),
+    device: str = typer.Option("cpu", help="cpu or cuda"),
+    jsonl: bool = typer.Option(False, "--jsonl", help="One JSON object per query instead of TSV rows")
+):
+    with open(queries, encoding="utf-8") as f:
+        qs = [line.strip() for line in f if line.strip()]
+    model, preprocess, tokenizer = load_model(device=device)
+    start_time = time.time()
+    results = search_batch(store, model, preprocess, tokenizer, qs, topk, folder, orientation, device)
+    elapsed = time.time() - start_time
+    typer.echo(f"{len(qs)} queries took {elapsed:.3f} seconds", err=True)
+
+    for q, hits in zip(qs, results):
+        if jsonl:
+            typer.echo(json.dumps({"query": q, "items": [{"path": p, "score": round(sc, 4)} for _, p, sc in hits]}))
+        else:
+            for rank, (_, path, score) in enumerate(hits, 1):
+                typer.echo(f"{q}\t{rank}\t{score:.3f}\t{path}")
+
 if __name__ == "__main__":
     app()
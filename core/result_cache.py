@@ -0,0 +1,121 @@
+# result_cache.py
+# Finished search responses, keyed on the query and the index generation they were
+# computed against (swapping in a new index bumps the generation and clears it), and
+# the ranked candidate lists behind pagination cursors.
+import threading, time, uuid
+from collections import OrderedDict
+
+# defaults for the "result_cache" block in config.json
+DEFAULT_RESULT_CACHE_CFG = {
+    "max_entries": 256,
+    "max_bytes": 32 << 20,
+}
+
+# defaults for the "pagination" block in config.json
+DEFAULT_PAGINATION_CFG = {
+    "depth": 1000,      # candidates held per paginated query
+    "ttl": 300.0,       # seconds a cursor stays valid after its last use
+    "max_cursors": 64,
+}
+
+def _approx_bytes(items):
+    # rough per-hit cost of a result dict or (images.id, score) pair
+    return sum(200 + len(it.get("path") or "") if isinstance(it, dict) else 64 for it in items)
+
+class ResultCache:
+    """LRU of search key -> result items, bounded by entry count and approximate bytes."""
+    def __init__(self, max_entries=256, max_bytes=32 << 20):
+        self.max_entries, self.max_bytes = int(max_entries), int(max_bytes)
+        self.generation = 0
+        self._d = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            hit = self._d.get((self.generation, key))
+            if hit is None:
+                self.misses += 1
+                return None
+            self._d.move_to_end((self.generation, key))
+            self.hits += 1
+            return hit[0]
+
+    def put(self, key, items, generation):
+        """Store unless the index was swapped while these results were being computed."""
+        size = _approx_bytes(items)
+        with self._lock:
+            if generation != self.generation or size > self.max_bytes:
+                return
+            k = (generation, key)
+            old = self._d.pop(k, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._d[k] = (items, size)
+            self._bytes += size
+            while len(self._d) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, n) = self._d.popitem(last=False)
+                self._bytes -= n
+                self.evictions += 1
+
+    def invalidate(self):
+        """New index in STATE: drop everything and start a new generation. Returns it."""
+        with self._lock:
+            self.generation += 1
+            self._d.clear()
+            self._bytes = 0
+            return self.generation
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "generation": self.generation, "entries": len(self._d), "bytes": self._bytes,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+class CursorStore:
+    """
+    Server-held ranked (images.id, score) candidates behind opaque cursors "<id>.<offset>".
+    images.id values (not row numbers) are kept, so pages stay valid across an index swap.
+    """
+    def __init__(self, ttl=300.0, max_cursors=64):
+        self.ttl, self.max_cursors = float(ttl), int(max_cursors)
+        self._d = OrderedDict()  # id -> (hits, expires)
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        for cid in [cid for cid, (_, exp) in self._d.items() if exp < now]:
+            del self._d[cid]
+        while len(self._d) > self.max_cursors:
+            self._d.popitem(last=False)
+
+    def new(self, hits, offset):
+        """Cursor pointing at hits[offset:], or None if nothing is left."""
+        if offset >= len(hits):
+            return None
+        cid = uuid.uuid4().hex
+        with self._lock:
+            now = time.monotonic()
+            self._d[cid] = (hits, now + self.ttl)
+            self._expire(now)
+        return f"{cid}.{offset}"
+
+    def page(self, cursor, limit):
+        """(hits for this page, next cursor or None); KeyError if unknown or expired."""
+        try:
+            cid, offset = cursor.rsplit(".", 1)
+            offset = int(offset)
+        except ValueError:
+            raise KeyError(cursor)
+        if offset < 0:
+            raise KeyError(cursor)
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            hits, _ = self._d[cid]
+            self._d[cid] = (hits, now + self.ttl)
+            self._d.move_to_end(cid)
+        end = offset + max(1, int(limit))
+        return hits[offset:end], (f"{cid}.{end}" if end < len(hits) else None)
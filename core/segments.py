@@ -0,0 +1,291 @@
+import os, json, shutil, threading
+import numpy as np
+
+from core.helpers.helpers import _atomic_save_npy, _atomic_write_json
+from core.numpy_index import QUANT_FILES, quantize
+from core.ivf_index import IVF_FILES, IVF_TAIL
+from core.attrs import ATTR_FILES
+
+# Vector store layout (under STORE_DIR):
+#   segments.json                  manifest: generation, segment list, tombstone file
+#   segments/seg_NNNNNN.vectors.npy  immutable float32 rows
+#   segments/seg_NNNNNN.ids.npy      images.id (int64) of those rows; no pickles, mmap-able
+#   segments/seg_NNNNNN.q.npy/.scale.npy  optional quantized scoring copy
+#   segments/tomb_NNNNNN.npy         packed bitmap of deleted rows (global row order)
+# Global row ids are the concatenation of segments in manifest order.
+SEGMENTS_DIR = "segments"
+MANIFEST = "segments.json"
+LEGACY_FILES = ("vectors.npy", "ids.npy")
+
+# one writer (index build, compaction, wipe) at a time per process
+WRITE_LOCK = threading.RLock()
+
+# rows copied per step while merging; bounds compaction memory
+_COPY_BLOCK = 65536
+
+class SegmentedMatrix:
+    """Read-only (N, D) view over a list of per-segment row arrays."""
+    ndim = 2
+
+    def __init__(self, parts):
+        self._parts = parts
+        self._offsets = np.cumsum([0] + [int(p.shape[0]) for p in parts])
+        self.shape = (int(self._offsets[-1]), int(parts[0].shape[1]))
+        self.dtype = parts[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            i = int(np.searchsorted(self._offsets, key, side="right")) - 1
+            return self._parts[i][key - self._offsets[i]]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            assert step == 1
+            out = []
+            for i, p in enumerate(self._parts):
+                lo, hi = self._offsets[i], self._offsets[i + 1]
+                s, e = max(start, lo), min(stop, hi)
+                if s < e:
+                    out.append(p[s - lo:e - lo])
+            if len(out) == 1:
+                return out[0]
+            return np.concatenate(out) if out else np.empty((0, self.shape[1]), dtype=self.dtype)
+        rows = np.asarray(key, dtype=np.int64)
+        seg = np.searchsorted(self._offsets, rows, side="right") - 1
+        out = np.empty((rows.shape[0], self.shape[1]), dtype=self.dtype)
+        for i in np.unique(seg):
+            sel = seg == i
+            out[sel] = self._parts[i][rows[sel] - self._offsets[i]]
+        return out
+
+def _seg_dir(store_dir):
+    return os.path.join(store_dir, SEGMENTS_DIR)
+
+def seg_path(store_dir, name, kind):
+    """kind: vectors|ids|q|scale"""
+    return os.path.join(store_dir, SEGMENTS_DIR, f"{name}.{kind}.npy")
+
+def read_manifest(store_dir):
+    p = os.path.join(store_dir, MANIFEST)
+    if not os.path.exists(p):
+        return None
+    with open(p) as f:
+        return json.load(f)
+
+def load_tombstones(store_dir, manifest) -> np.ndarray:
+    """bool[N] of deleted rows (all False if none recorded)."""
+    n = sum(s["rows"] for s in manifest["segments"])
+    name = manifest.get("tombstones")
+    if not name:
+        return np.zeros(n, dtype=bool)
+    bits = np.load(os.path.join(_seg_dir(store_dir), name))
+    return np.unpackbits(bits, count=n).astype(bool)
+
+def load_ids(store_dir, manifest) -> np.ndarray:
+    """int64 images.id per global row; a single-segment store stays memory-mapped."""
+    parts = [np.load(seg_path(store_dir, s["name"], "ids"), mmap_mode="r") for s in manifest["segments"]]
+    if len(parts) == 1:
+        return parts[0]
+    return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+def rows_by_id(ids, dead=None):
+    """(sorted image ids, their rows) over live rows, for rows_of()."""
+    rows = np.arange(len(ids)) if dead is None else np.flatnonzero(~dead)
+    order = np.argsort(np.asarray(ids)[rows], kind="stable")
+    return np.asarray(ids)[rows][order], rows[order]
+
+def rows_of(lookup, image_ids) -> np.ndarray:
+    """Row of each images.id (-1 if it has no live vector)."""
+    sorted_ids, rows = lookup
+    image_ids = np.asarray(image_ids, dtype=np.int64)
+    if sorted_ids.size == 0:
+        return np.full(image_ids.shape, -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(sorted_ids, image_ids), sorted_ids.size - 1)
+    return np.where(sorted_ids[pos] == image_ids, rows[pos], -1)
+
+def _concat(parts):
+    return parts[0] if len(parts) == 1 else SegmentedMatrix(parts)
+
+def open_segments(store_dir, quantize_kind="none"):
+    """
+    Memory-map the whole store. Returns dict(X, codes, scales, ids, dead, generation);
+    codes/scales are None unless every segment carries `quantize_kind` codes.
+    """
+    m = read_manifest(store_dir)
+    if m is None:
+        # stores written before segments are converted by migrate_store()
+        raise RuntimeError("vectors missing. Rebuild index.")
+    if any(s.get("ids") != "int64" for s in m["segments"]):
+        raise RuntimeError("Store ids need migrating. Rebuild index.")
+
+    segs = m["segments"]
+    if not segs:
+        raise RuntimeError("Store is empty. Rebuild index.")
+    X = _concat([np.load(seg_path(store_dir, s["name"], "vectors"), mmap_mode="r") for s in segs])
+    codes = scales = None
+    if quantize_kind != "none" and all(s.get("quant") == quantize_kind for s in segs):
+        codes = _concat([np.load(seg_path(store_dir, s["name"], "q"), mmap_mode="r") for s in segs])
+        if quantize_kind == "int8":
+            scales = np.concatenate([np.load(seg_path(store_dir, s["name"], "scale")) for s in segs])
+    dead = load_tombstones(store_dir, m)
+    return {"X": X, "codes": codes, "scales": scales, "ids": load_ids(store_dir, m),
+            "dead": dead if dead.any() else None, "generation": int(m.get("generation", 0))}
+
+def write_segment_codes(store_dir, name, X, kind):
+    """(Re)write a segment's quantized copy block by block; returns the kind written or None."""
+    codes_path, scale_path = seg_path(store_dir, name, "q"), seg_path(store_dir, name, "scale")
+    for p in (codes_path, scale_path):
+        if os.path.exists(p):
+            os.remove(p)
+    if kind == "none":
+        return None
+    n = int(X.shape[0])
+    codes_out = np.lib.format.open_memmap(codes_path + ".tmp", mode="w+", shape=X.shape,
+                                          dtype=np.float16 if kind == "fp16" else np.int8)
+    scales_out = np.empty(n, dtype=np.float32) if kind == "int8" else None
+    for s in range(0, n, _COPY_BLOCK):
+        codes, scales = quantize(np.asarray(X[s:s + _COPY_BLOCK], dtype=np.float32), kind)
+        codes_out[s:s + _COPY_BLOCK] = codes
+        if scales_out is not None:
+            scales_out[s:s + _COPY_BLOCK] = scales
+    codes_out.flush()
+    del codes_out
+    os.replace(codes_path + ".tmp", codes_path)
+    if scales_out is not None:
+        _atomic_save_npy(scale_path, scales_out)
+    return kind
+
+def write_segment(store_dir, name, ids, X, quantize_kind="none") -> dict:
+    """Persist a new immutable segment and return its manifest entry."""
+    os.makedirs(_seg_dir(store_dir), exist_ok=True)
+    _atomic_save_npy(seg_path(store_dir, name, "vectors"), np.asarray(X, dtype=np.float32))
+    _atomic_save_npy(seg_path(store_dir, name, "ids"), np.asarray(ids, dtype=np.int64))
+    quant = write_segment_codes(store_dir, name, X, quantize_kind)
+    return {"name": name, "rows": int(X.shape[0]), "quant": quant, "ids": "int64"}
+
+def new_segment_name(manifest) -> str:
+    return f"seg_{int((manifest or {}).get('next_id', 0)):06d}"
+
+def commit_manifest(store_dir, prev, segments, dead) -> dict:
+    """Atomically switch the store to `segments` + `dead`; unreferenced files are removed."""
+    gen = int((prev or {}).get("generation", 0)) + 1
+    names = [s["name"] for s in segments]
+    next_id = max([int((prev or {}).get("next_id", 0))] + [int(n.split("_")[1]) + 1 for n in names])
+    os.makedirs(_seg_dir(store_dir), exist_ok=True)
+    tomb = None
+    if dead is not None and dead.any():
+        tomb = f"tomb_{gen:06d}.npy"
+        _atomic_save_npy(os.path.join(_seg_dir(store_dir), tomb), np.packbits(dead))
+    m = {"generation": gen, "next_id": next_id, "segments": segments, "tombstones": tomb}
+    _atomic_write_json(os.path.join(store_dir, MANIFEST), m)
+    _gc_segments(store_dir, m)
+    return m
+
+def _gc_segments(store_dir, manifest):
+    keep = {manifest.get("tombstones")}
+    for s in manifest["segments"]:
+        keep.update(os.path.basename(seg_path(store_dir, s["name"], k)) for k in ("vectors", "ids", "q", "scale"))
+    for fn in os.listdir(_seg_dir(store_dir)):
+        if fn not in keep:
+            try:
+                os.remove(os.path.join(_seg_dir(store_dir), fn))
+            except Exception:
+                pass  # still mapped by a reader on Windows; next commit retries
+
+def migrate_legacy(store_dir):
+    """Turn a pre-segment store (top-level vectors.npy/ids.npy) into segment 0."""
+    if read_manifest(store_dir) is not None:
+        return
+    vecs_path, ids_path = (os.path.join(store_dir, n) for n in LEGACY_FILES)
+    if not (os.path.exists(vecs_path) and os.path.exists(ids_path)):
+        return
+    os.makedirs(_seg_dir(store_dir), exist_ok=True)
+    name = new_segment_name(None)
+    rows = int(np.load(vecs_path, mmap_mode="r").shape[0])
+    os.replace(vecs_path, seg_path(store_dir, name, "vectors"))
+    os.replace(ids_path, seg_path(store_dir, name, "ids"))
+    for fn in QUANT_FILES:
+        p = os.path.join(store_dir, fn)
+        if os.path.exists(p):
+            os.remove(p)
+    commit_manifest(store_dir, None, [{"name": name, "rows": rows, "quant": None}], None)
+
+def migrate_ids(store_dir, con):
+    """
+    Rewrite segments that still carry pickled path strings as int64 images.id arrays.
+    Rows whose path is no longer in `images` are tombstoned.
+    """
+    m = read_manifest(store_dir)
+    if m is None or all(s.get("ids") == "int64" for s in m["segments"]):
+        return
+    id_of = dict(con.execute("SELECT path, id FROM images"))
+    dead = load_tombstones(store_dir, m)
+    segs, pos = [], 0
+    for seg in m["segments"]:
+        if seg.get("ids") != "int64":
+            paths = np.load(seg_path(store_dir, seg["name"], "ids"), allow_pickle=True)
+            ids = np.fromiter((id_of.get(str(p), -1) for p in paths), dtype=np.int64, count=len(paths))
+            dead[pos:pos + len(ids)] |= ids < 0
+            _atomic_save_npy(seg_path(store_dir, seg["name"], "ids"), ids)
+            seg = {**seg, "ids": "int64"}
+        segs.append(seg)
+        pos += seg["rows"]
+    commit_manifest(store_dir, m, segs, dead)
+
+def migrate_store(store_dir, con):
+    """Bring an older store up to the current layout (segments, int64 ids) in place."""
+    with WRITE_LOCK:
+        migrate_legacy(store_dir)
+        migrate_ids(store_dir, con)
+
+def merge_segments(store_dir, manifest, dead, start: int, quantize_kind="none"):
+    """
+    Stream the live rows of segments[start:] into one new segment (bounded memory).
+    Segments before `start` are kept as-is. Returns (segments, dead) for commit_manifest.
+    """
+    segs = manifest["segments"]
+    offsets = np.cumsum([0] + [s["rows"] for s in segs])
+    keep_segs = segs[:start]
+    head_dead = dead[:offsets[start]]
+    tail_live = ~dead[offsets[start]:]
+    n_out = int(tail_live.sum())
+    if n_out == 0:
+        return keep_segs, head_dead
+
+    name = new_segment_name(manifest)
+    dim = int(np.load(seg_path(store_dir, segs[0]["name"], "vectors"), mmap_mode="r").shape[1])
+    out_path = seg_path(store_dir, name, "vectors")
+    out = np.lib.format.open_memmap(out_path + ".tmp", mode="w+", dtype=np.float32, shape=(n_out, dim))
+    ids_out, pos = [], 0
+    for j, s in enumerate(segs[start:]):
+        V = np.load(seg_path(store_dir, s["name"], "vectors"), mmap_mode="r")
+        I = np.load(seg_path(store_dir, s["name"], "ids"), mmap_mode="r")
+        live = tail_live[offsets[start + j] - offsets[start]:offsets[start + j + 1] - offsets[start]]
+        for b in range(0, s["rows"], _COPY_BLOCK):
+            blk = V[b:b + _COPY_BLOCK][live[b:b + _COPY_BLOCK]]
+            out[pos:pos + blk.shape[0]] = blk
+            pos += blk.shape[0]
+        ids_out.append(I[live])
+    out.flush()
+    del out
+    os.replace(out_path + ".tmp", out_path)
+    _atomic_save_npy(seg_path(store_dir, name, "ids"), np.concatenate(ids_out).astype(np.int64))
+    merged = np.load(out_path, mmap_mode="r")
+    quant = write_segment_codes(store_dir, name, merged, quantize_kind)
+    entry = {"name": name, "rows": n_out, "quant": quant, "ids": "int64"}
+    return keep_segs + [entry], np.concatenate([head_dead, np.zeros(n_out, dtype=bool)])
+
+def wipe_store_files(store_dir):
+    """Delete every index artifact (vectors, segments, derived files, config); keeps meta.sqlite."""
+    with WRITE_LOCK:
+        for name in ("index.faiss", *LEGACY_FILES, "config.json", MANIFEST,
+                     *IVF_FILES, IVF_TAIL, *QUANT_FILES, *ATTR_FILES):
+            p = os.path.join(store_dir, name)
+            try:
+                if os.path.exists(p):
+                    os.remove(p)
+            except Exception:
+                pass
+        shutil.rmtree(_seg_dir(store_dir), ignore_errors=True)
@@ -1,22 +1,34 @@
 # server.py
-import os, io, json, platform, subprocess
-
-from core.numpy_index import NumpyIndex
+import os, io, json, base64, hashlib, platform, shutil, struct, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from core.ivf_index import index_cfg, load_index
+from core.segments import WRITE_LOCK, migrate_store, open_segments, rows_by_id, rows_of, wipe_store_files
+from core.attrs import build_attrs, load_attrs
+from core.watcher import Watcher, watch_cfg
+from core.compute import ComputeBusy, ComputePool, compute_cfg
+from core.db_pool import PoolClosed, ReadPool, db_cfg
+from core.folders import FolderTree, ensure_folder_stats
+from core.result_cache import DEFAULT_PAGINATION_CFG, DEFAULT_RESULT_CACHE_CFG, CursorStore, ResultCache
+from core.thumbs import (
+    FORMATS, MIME, backfill_thumbs, close_pack, derive_thumb, encode_thumb, ensure_thumb_table, gc_thumbs, open_pack,
+    pick_format, record_thumbs, size_bucket, thumb_cfg, thumb_etag,
+)
 os.environ.setdefault("OMP_NUM_THREADS", "4")
 os.environ.setdefault("MKL_NUM_THREADS", "4")
+from contextlib import contextmanager
 from typing import Optional
 import uuid
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from PIL import Image
 import numpy as np
 import sqlite3
 import uvicorn
 import threading
 import time
-from PIL import Image, ImageOps
 
 # ---- CONFIG ----
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -26,25 +38,82 @@ DEFAULT_STORE = os.path.join(PROJECT_ROOT, "store")
 STORE_DIR = os.path.abspath(os.path.expanduser(os.environ.get("REFSEARCH_STORE", DEFAULT_STORE)))
 PORT = int(os.environ.get("REFSEARCH_PORT", "54999"))
 THUMB_DIR = os.path.join(STORE_DIR, "thumbs")
+TEXT_CACHE_PATH = os.path.join(STORE_DIR, "text_cache.npz")
 os.makedirs(THUMB_DIR, exist_ok=True)
 os.makedirs(STORE_DIR, exist_ok=True)
 
 # ---- LOAD CORE (your existing code) ----
 from core.commands.nuke import _wipe_store
 from core.helpers.helpers import _detect_overlaps, _norm_path
-from core.models import load_model, embed_texts, embed_images  # you already have these
+from core.helpers.images import EMBED_SIDE, ImageTooLarge, load_rgb
+from core.models import load_model, embed_texts, embed_images, normalize_query, TextEmbeddingCache  # you already have these
 # import faiss
 
 class SearchFilters(BaseModel):
     folder: Optional[str] = None
     orientation: Optional[str] = None
+    root: Optional[str] = None
 
 class SearchTextBody(BaseModel):
     q: str
     topk: int = 50
     filters: Optional[SearchFilters] = None
+    paginate: bool = False  # hold more ranked candidates server-side; response gets a cursor
+    stream: bool = False    # NDJSON: one hit per line, then {"done": true, "cursor": ...}
+
+class BatchQuery(BaseModel):
+    text: Optional[str] = None
+    path: Optional[str] = None       # an indexed image; its stored vector is reused
+    image_b64: Optional[str] = None  # any other image, base64 file bytes
+
+class SearchBatchBody(BaseModel):
+    queries: list[BatchQuery]
+    topk: int = 50
+    filters: Optional[SearchFilters] = None
+
+MAX_BATCH_QUERIES = 4096
+
+class ThumbsBody(BaseModel):
+    paths: list[str] = []
+    ids: list[int] = []             # "id" of search result items
+    size: Optional[int] = None
+    format: Optional[str] = None    # jpeg|webp|avif; picked from the Accept header if unset
+
+MAX_BATCH_THUMBS = 512
+
+class _UploadLimit:
+    """
+    413 for /search_image bodies over compute.max_upload_mb while they arrive, so an
+    oversized upload is never spooled to memory/disk: by Content-Length up front,
+    otherwise by counting the streamed chunks.
+    """
+    SLACK = 64 << 10  # multipart boundaries + the small form fields
+
+    def __init__(self, app, paths=("/search_image",)):
+        self.app, self.paths = app, set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        mb = STATE["compute_cfg"]["max_upload_mb"]
+        cap = int(mb * (1 << 20)) + self.SLACK
+        detail = f"Upload is over {mb} MB."
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > cap:
+            return await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+        seen = 0
+        async def limited():
+            nonlocal seen
+            msg = await receive()
+            if msg["type"] == "http.request":
+                seen += len(msg.get("body", b""))
+                if seen > cap:
+                    raise HTTPException(413, detail)
+            return msg
+        await self.app(scope, limited, send)
 
 app = FastAPI()
+app.add_middleware(_UploadLimit)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:54998", "http://127.0.0.1:54998", "tauri://localhost"],
@@ -61,11 +130,31 @@ STATE = {
     "tokenizer": None,
     "index": None,
     "ids": None,
-    "con": None,
+    "db": None,     # ReadPool over meta.sqlite
+    "attrs": None,
     "dim": 0
 }
 STATE["cancel_event"] = threading.Event()
 STATE["swap_lock"]   = threading.RLock()
+STATE["watcher"]     = None
+STATE["text_cache"]  = None
+STATE["results"]     = ResultCache()  # finished responses for the current index generation
+STATE["generation"]  = 0
+_BOOT = uuid.uuid4().hex[:8]  # generations restart with the process; keeps ETags from colliding
+STATE["cursors"]     = CursorStore()
+STATE["page_depth"]  = DEFAULT_PAGINATION_CFG["depth"]
+STATE["thumbs"]      = thumb_cfg(None)
+STATE["thumb_stop"]  = threading.Event()  # stops the running thumbnail backfill
+STATE["thumb_pool"]  = None  # makes missing thumbnails for /thumbs
+STATE["compute_cfg"] = compute_cfg(None)
+STATE["compute"]     = ComputePool(STATE["compute_cfg"]["workers"], STATE["compute_cfg"]["max_queue"])
+
+# defaults for the "text_cache" block in config.json
+DEFAULT_TEXT_CACHE_CFG = {
+    "max_entries": 2048,
+    "max_bytes": 16 << 20,
+    "persist": True,   # keep it in STORE_DIR/text_cache.npz across restarts
+}
 
 def pick_device():
     import torch
@@ -73,95 +162,149 @@ def pick_device():
     if hasattr(torch.backends, "mps") and torch.backends.mps.is_available(): return "mps"
     return "cpu"
 
+# everything load_store() hands over; swapped into STATE as one unit
+_EMPTY_STORE = {"index": None, "ids": None, "id_rows": None, "db": None, "attrs": None, "folders": None}
+
 def try_load_store():
     try:
         return load_store()  
     except Exception:
-        return None, None, None  # if no index yet
+        return dict(_EMPTY_STORE)  # if no index yet
 
 def load_store():
-    vecs_path = os.path.join(STORE_DIR, "vectors.npy")
-    # idx_path = os.path.join(STORE_DIR, "index.faiss")
-    ids_path = os.path.join(STORE_DIR, "ids.npy")
     db_path  = os.path.join(STORE_DIR, "meta.sqlite")
     cfg_path = os.path.join(STORE_DIR, "config.json")
 
-    for p in (cfg_path, vecs_path, ids_path, db_path):
-    # for p in (cfg_path, idx_path, ids_path, db_path):
+    for p in (cfg_path, db_path):
         if not os.path.exists(p):
             raise RuntimeError(f"{os.path.basename(p)} missing. Rebuild index.")
 
     cfg = json.load(open(cfg_path))
-    # index = faiss.read_index(idx_path)
-    # if cfg.get("dim") != index.d:
-    #     raise RuntimeError("Index/model dimension mismatch. Please reindex.")
-    # memory-map to keep RSS low
-    X = np.load(vecs_path, mmap_mode="r")
-    if cfg.get("dim") != int(X.shape[1]):
-        raise RuntimeError("Index/model dimension mismatch. Please reindex.")
-    index = NumpyIndex(X)
-
-    ids = np.load(ids_path, allow_pickle=True)
+    # one short-lived writer for upgrades; requests only ever get read-only connections
     con = sqlite3.connect(db_path, check_same_thread=False, timeout=5.0)
-    con.execute("PRAGMA busy_timeout=5000;") # give a timeout
-    return index, ids, con
+    try:
+        con.execute("PRAGMA busy_timeout=5000;") # give a timeout
+        con.execute("PRAGMA journal_mode=WAL;")  # readers never block on the indexer
+        ensure_thumb_table(con)  # stores indexed before thumbnails were tracked
+        ensure_folder_stats(con)
+        # a build/compaction commits manifests and deletes the segments they replace:
+        # open everything it writes while none is running (mmaps outlive the lock)
+        with WRITE_LOCK:
+            migrate_store(STORE_DIR, con)  # path-keyed stores -> int64 images.id
+            # memory-map every vector segment to keep RSS low
+            seg = open_segments(STORE_DIR, index_cfg(cfg)["quantize"])
+            if cfg.get("dim") != int(seg["X"].shape[1]):
+                raise RuntimeError("Index/model dimension mismatch. Please reindex.")
+            index = load_index(STORE_DIR, seg, cfg)  # flat or IVF, per config.json
+
+            # rows carry images.id; paths (the strings) only live in the DB
+            ids = seg["ids"]
+            # filter columns; derive them from the DB if the store predates them
+            attrs = load_attrs(STORE_DIR, len(ids)) or build_attrs(con, ids)
+        folders = FolderTree.load(con)
+    finally:
+        con.close()
+    dcfg = db_cfg(cfg)
+    db = ReadPool(db_path, dcfg["readers"], dcfg["mmap_mb"], dcfg["cache_mb"], dcfg["timeout"])
+    return {"index": index, "ids": ids, "id_rows": rows_by_id(ids, seg["dead"]), "db": db, "attrs": attrs,
+            "folders": folders}
+
+def _swap_store(store: dict):
+    """Hot-swap a loaded store (or _EMPTY_STORE) into STATE and close the old DB pool."""
+    with STATE["swap_lock"]:
+        old_db = STATE.get("db")
+        STATE.update(store)
+        STATE["dim"] = 0 if store["index"] is None else store["index"].d
+        # cached responses belong to the old index
+        STATE["generation"] = STATE["results"].invalidate()
+    # requests still holding one of its connections finish; it closes when returned
+    if old_db is not None and old_db is not store["db"]:
+        old_db.close()
+
+@contextmanager
+def _db():
+    """A pooled read-only connection to the live store's DB for the block (None before an index exists)."""
+    while True:
+        pool = STATE.get("db")
+        if pool is None:
+            con = None
+            break
+        try:
+            con = pool.acquire()
+            break
+        except PoolClosed:
+            continue  # swapped out while we waited; take the new one
+        except TimeoutError:
+            raise HTTPException(503, "Database busy, try again shortly.", headers={"Retry-After": "1"})
+    try:
+        yield con
+    finally:
+        if con is not None:
+            pool.release(con)
 
 # force reset indexes
 def _reload_store_from_disk():
     """Reload index/ids/DB from disk and hot-swap into STATE, or clear if missing."""
-    try:
-        idx, ids, con = load_store()
-    except Exception:
-        idx, ids, con = None, None, None
-
-    with STATE["swap_lock"]:
-        # close old con if we’re swapping to a new one
-        old_con = STATE.get("con")
-        STATE["index"], STATE["ids"], STATE["con"] = idx, ids, con
-        STATE["dim"] = 0 if idx is None else idx.d
+    _swap_store(try_load_store())
+
+def ensure_thumb(path, size=None, fmt="jpeg", variants=None):
+    """
+    Make + pack a thumbnail variant inline. It is derived from the largest cached
+    variant at least `size` big (`variants`: {(size, fmt): (shard, offset, length)});
+    only without one is the original decoded again.
+    """
+    tcfg = STATE["thumbs"]
+    size = int(size or tcfg["size"])
+    pack = open_pack(THUMB_DIR, tcfg)
+    data = None
+    for (vsize, _), loc in sorted((variants or {}).items(), reverse=True):
+        if vsize < size:
+            break
+        src = pack.read(*loc)
+        if src is not None:
+            try:
+                data = derive_thumb(src, size, fmt, tcfg)
+                break
+            except Exception:
+                continue
+    if data is None:
         try:
-            if old_con and old_con is not con:
-                old_con.close()
+            data = encode_thumb(path, tcfg, size=size, fmt=fmt)
         except Exception:
-            pass
-
-def get_meta(path):
-    con = STATE.get("con")
-    if con is None:
-        return (None, None, None, None)
-    cur = con.cursor()
-    row = cur.execute("SELECT width,height,orientation,folder FROM images WHERE path=?", (path,)).fetchone()
-    if not row: return (None, None, None, None)
-    return row # width,height,orientation,folder
-
-def ensure_thumb(path, size=512):
-    import hashlib, os
-    ver = "v2"  # bump if you change the logic again
-    mtime = int(os.path.getmtime(path)) if os.path.exists(path) else 0
-    key = hashlib.md5(f"{path}|{size}|{ver}|{mtime}".encode("utf-8")).hexdigest() + ".jpg"
-    out = os.path.join(THUMB_DIR, key)
-    if not os.path.exists(out):
+            return None
+    loc = pack.put(data)
+    try:
+        con = sqlite3.connect(os.path.join(STORE_DIR, "meta.sqlite"), timeout=5.0)
+        with con:
+            record_thumbs(con, [(path, size, fmt, *loc)])
+        con.close()
+    except sqlite3.Error:
+        pass  # served anyway; made again next time
+    return data
+
+def _stop_thumb_backfill():
+    STATE["thumb_stop"].set()
+
+def _start_thumb_backfill():
+    """Fill in thumbnails for indexed images without one (older stores, failed writes)."""
+    _stop_thumb_backfill()
+    STATE["thumbs"] = tcfg = thumb_cfg(_store_cfg())
+    if not tcfg["pregenerate"] or STATE["db"] is None:
+        return
+    stop = STATE["thumb_stop"] = threading.Event()
+    def worker():
+        db_path = os.path.join(STORE_DIR, "meta.sqlite")
         try:
-            im = Image.open(path)
-            # Honor EXIF orientation for JPEGs, etc.
-            im = ImageOps.exif_transpose(im)
-
-            # If transparent, composite over white so background isn't black
-            if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
-                im = im.convert("RGBA")
-                bg = Image.new("RGBA", im.size, (255, 255, 255, 255))
-                im = Image.alpha_composite(bg, im).convert("RGB")
-            else:
-                im = im.convert("RGB")
-
-            # Resize thumbnail
-            im.thumbnail((size, size), Image.LANCZOS)  # or Resampling.LANCZOS
-
-            # Save as high-quality JPEG
-            im.save(out, "JPEG", quality=95, optimize=True, progressive=True)
+            backfill_thumbs(db_path, THUMB_DIR, tcfg, stop)
+            # builds record thumbnails while holding the write lock; don't collect under them
+            if not stop.is_set() and WRITE_LOCK.acquire(blocking=False):
+                try:
+                    gc_thumbs(db_path, THUMB_DIR, tcfg)
+                finally:
+                    WRITE_LOCK.release()
         except Exception:
-            return None
-    return out
+            pass  # /thumb still makes them on demand
+    threading.Thread(target=worker, daemon=True).start()
 
 @app.on_event("startup")
 def startup():
@@ -180,102 +323,389 @@ def startup():
     except Exception:
         pass
 
-    idx, ids, con = try_load_store()
-    STATE["index"], STATE["ids"], STATE["con"] = idx, ids, con
-    STATE["dim"] = 0 if idx is None else idx.d
+    tcfg = {**DEFAULT_TEXT_CACHE_CFG, **(_store_cfg().get("text_cache") or {})}
+    STATE["text_cache"] = TextEmbeddingCache(
+        tcfg["max_entries"], tcfg["max_bytes"], path=TEXT_CACHE_PATH if tcfg["persist"] else None)
+    STATE["text_cache"].load(STATE["model"])
+    rcfg = {**DEFAULT_RESULT_CACHE_CFG, **(_store_cfg().get("result_cache") or {})}
+    STATE["results"].max_entries, STATE["results"].max_bytes = int(rcfg["max_entries"]), int(rcfg["max_bytes"])
+    pcfg = {**DEFAULT_PAGINATION_CFG, **(_store_cfg().get("pagination") or {})}
+    STATE["cursors"] = CursorStore(pcfg["ttl"], pcfg["max_cursors"])
+    STATE["page_depth"] = int(pcfg["depth"])
+    ccfg = compute_cfg(_store_cfg())
+    if (ccfg["workers"], ccfg["max_queue"]) != (STATE["compute_cfg"]["workers"], STATE["compute_cfg"]["max_queue"]):
+        STATE["compute"].shutdown()
+        STATE["compute"] = ComputePool(ccfg["workers"], ccfg["max_queue"])
+    STATE["compute_cfg"] = ccfg
+
+    _swap_store(try_load_store())
+    _restart_watcher()
+    _start_thumb_backfill()
+
+@app.on_event("shutdown")
+def shutdown():
+    _stop_watcher()
+    _stop_thumb_backfill()
+    if STATE["thumb_pool"] is not None:
+        STATE["thumb_pool"].shutdown(wait=False, cancel_futures=True)
+    STATE["compute"].shutdown()
+    if STATE["text_cache"] is not None:
+        STATE["text_cache"].save()
 
 @app.get("/ready")
 def ready():
-    has_index = STATE["index"] is not None and STATE["ids"] is not None and STATE["con"] is not None
+    db = STATE["db"]
+    has_index = STATE["index"] is not None and STATE["ids"] is not None and db is not None
     return {
         "ok": True,
-        "indexed": int(STATE["index"].ntotal) if has_index else 0,
+        "indexed": int(STATE["index"].nlive) if has_index else 0,
         "has_index": has_index,
         "device": STATE["device"],
-        "dim": STATE["dim"]
+        "dim": STATE["dim"],
+        "mode": STATE["index"].mode if has_index else None,
+        "watch": STATE["watcher"].status() if STATE["watcher"] else None,
+        "text_cache": STATE["text_cache"].stats() if STATE["text_cache"] else None,
+        "result_cache": STATE["results"].stats(),
+        "compute": STATE["compute"].stats(),
+        "db": db.stats() if has_index else None,
     }
 
-def _post_filter(items, filters: Optional[SearchFilters]):
-    if not filters: return items
-    out = []
-    for p, score in items:
-        w,h,ori,folder = get_meta(p)
-        if filters.folder and folder != filters.folder: continue
-        if filters.orientation and ori != filters.orientation: continue
-        out.append({
-            "path": p, "score": score,
-            "width": w, "height": h, "orientation": ori, "folder": folder
-        })
-    return out
+def _compute(fn, *args):
+    """Run CPU-heavy handler work on the bounded compute pool; a full queue is a 503."""
+    try:
+        return STATE["compute"].run(fn, *args)
+    except ComputeBusy:
+        raise HTTPException(503, "Server busy, try again shortly.", headers={"Retry-After": "1"})
+
+def _query_image(raw: bytes):
+    """Decode an uploaded query image, downscaled while decoding; oversized ones are a 413."""
+    try:
+        _, im = load_rgb(io.BytesIO(raw), min_side=EMBED_SIDE, max_pixels=STATE["compute_cfg"]["max_pixels"])
+    except ImageTooLarge as e:
+        raise HTTPException(413, str(e))
+    return im
+
+def _snapshot():
+    """(index, ids, id_rows, attrs) of one store, so a concurrent swap can't mix row numberings."""
+    with STATE["swap_lock"]:
+        index, ids, id_rows, attrs = STATE["index"], STATE["ids"], STATE["id_rows"], STATE.get("attrs")
+    if index is None or ids is None:
+        raise HTTPException(status_code=409, detail="Index not built yet. Please run /reindex.")
+    return index, ids, id_rows, attrs
+
+def _filter_mask(filters: Optional[SearchFilters], attrs):
+    """Row mask from the in-memory filter columns (None = no filtering)."""
+    if not filters or attrs is None:
+        return None
+    return attrs.mask(folder=filters.folder, orientation=filters.orientation, root=filters.root)
+
+def _result_items(items):
+    """
+    path/width/height/orientation/folder for (images.id, score) hits, gathered from the
+    in-memory columns; no DB access. Hits deleted since they were ranked are dropped.
+    """
+    with STATE["swap_lock"]:  # columns and id lookup must come from the same store
+        attrs, id_rows = STATE.get("attrs"), STATE.get("id_rows")
+    if not items or attrs is None:
+        return []
+    iids = np.fromiter((i for i, _ in items), dtype=np.int64, count=len(items))
+    rows = rows_of(id_rows, iids)
+    keep = np.flatnonzero(rows >= 0)
+    return attrs.items(rows[keep], iids[keep].tolist(), [items[k][1] for k in keep.tolist()])
+
+def _search_hits(qvec, topk: int, filters: Optional[SearchFilters]):
+    """Ranked (images.id, score) pairs; filters are applied inside the scan, so topk counts filtered hits."""
+    index, ids, _, attrs = _snapshot()
+    D, I = index.search(qvec, topk, mask=_filter_mask(filters, attrs))
+    return [(int(ids[i]), float(d)) for i, d in zip(I[0], D[0]) if i != -1]
+
+def _search(qvec, topk: int, filters: Optional[SearchFilters]):
+    return _result_items(_search_hits(qvec, topk, filters))
+
+def _ndjson(hits, cursor, chunk=20):
+    """Stream hits as NDJSON, a few rows at a time so the first ones go out early."""
+    def gen():
+        for s in range(0, len(hits), chunk):
+            for item in _result_items(hits[s:s + chunk]):
+                yield json.dumps(item) + "\n"
+        yield json.dumps({"done": True, "cursor": cursor}) + "\n"
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
 
 # make sure an index actually exists before running
 def _require_index():
-    if not (STATE["index"] is not None and STATE["ids"] is not None and STATE["con"] is not None):
+    if not (STATE["index"] is not None and STATE["ids"] is not None and STATE["db"] is not None):
         raise HTTPException(status_code=409, detail="Index not built yet. Please run /reindex.")
 
+def _filters_key(filters: Optional[SearchFilters]):
+    if not filters:
+        return None
+    key = (filters.folder, filters.orientation, filters.root)
+    return None if key == (None, None, None) else key
+
+def _cached_search(key, topk: int, filters: Optional[SearchFilters], make_qvec, hits_only=False):
+    """
+    Serve (query key, topk, filters) from the response cache, else embed + search + fill it.
+    With hits_only, the cached value is the ranked (images.id, score) list without metadata.
+    """
+    key = (*key, int(topk), _filters_key(filters), hits_only)
+    gen = STATE["results"].generation  # read before touching the index
+    items = STATE["results"].get(key)
+    if items is None:
+        find = _search_hits if hits_only else _search
+        items = _compute(lambda: find(make_qvec(), topk, filters))  # embed + scan off the request thread
+        STATE["results"].put(key, items, gen)
+    return items
+
+def _search_response(key, topk: int, filters: Optional[SearchFilters], make_qvec, paginate=False, stream=False):
+    if not paginate and not stream:
+        return {"items": _cached_search(key, topk, filters, make_qvec)}
+    # rank deeper once; later pages are slices of the held list, no re-scoring
+    depth = max(topk, STATE["page_depth"]) if paginate else topk
+    hits = _cached_search(key, depth, filters, make_qvec, hits_only=True)
+    cursor = STATE["cursors"].new(hits, topk) if paginate else None
+    if stream:
+        return _ndjson(hits[:topk], cursor)
+    return {"items": _result_items(hits[:topk]), "cursor": cursor}
+
 # this is what happens when we give our server some text to run
 @app.post("/search_text")
 def search_text(body: SearchTextBody):
     _require_index()
-    qvec = embed_texts(STATE["model"], STATE["tokenizer"], [body.q], device=STATE["device"]).astype("float32")
-    D, I = STATE["index"].search(qvec, body.topk)
-    items = [(STATE["ids"][i], float(d)) for i, d in zip(I[0], D[0]) if i != -1]
-    return {"items": _post_filter(items, body.filters)}
+    def qvec():
+        return embed_texts(STATE["model"], STATE["tokenizer"], [body.q], device=STATE["device"],
+                           cache=STATE["text_cache"]).astype("float32")
+    return _search_response(("text", normalize_query(body.q)), body.topk, body.filters, qvec,
+                            paginate=body.paginate, stream=body.stream)
 
 @app.post("/search_image")
-async def search_image(file: UploadFile = File(...), filters: Optional[str] = Form(None), topk: int = Form(50)):
+async def search_image(file: UploadFile = File(...), filters: Optional[str] = Form(None), topk: int = Form(50),
+                       paginate: bool = Form(False), stream: bool = Form(False)):
     _require_index()  # protect
     # parse filters json if present
     fobj = None
     if filters:
         try: fobj = SearchFilters(**json.loads(filters))
         except Exception: fobj = None
-    raw = await file.read()
-    im = Image.open(io.BytesIO(raw)).convert("RGB")
-    qvec = embed_images(STATE["model"], [STATE["preprocess"](im)], device=STATE["device"]).astype("float32")
-    D, I = STATE["index"].search(qvec, topk)
-    items = [(STATE["ids"][i], float(d)) for i, d in zip(I[0], D[0]) if i != -1]
-    return {"items": _post_filter(items, fobj)}
+    cap = int(STATE["compute_cfg"]["max_upload_mb"] * (1 << 20))
+    raw = await file.read(cap + 1)
+    if len(raw) > cap:
+        raise HTTPException(413, f"Upload is over {STATE['compute_cfg']['max_upload_mb']} MB.")
+    def qvec():
+        im = _query_image(raw)
+        return embed_images(STATE["model"], [STATE["preprocess"](im)], device=STATE["device"]).astype("float32")
+    # never decode/embed on the event loop; the hashing, cache and DB work goes to a thread too
+    # same upload bytes -> same embedding
+    return await run_in_threadpool(_search_response, ("image", hashlib.sha1(raw).hexdigest()), topk, fobj, qvec,
+                                   paginate, stream)
+
+@app.get("/search_page")
+def search_page(cursor: str, limit: int = 60, stream: bool = False):
+    """Next page of a paginated /search_text or /search_image from its cursor."""
+    try:
+        hits, nxt = STATE["cursors"].page(cursor, limit)
+    except KeyError:
+        raise HTTPException(410, "Cursor expired. Run the search again.")
+    if stream:
+        return _ndjson(hits, nxt)
+    return {"items": _result_items(hits), "cursor": nxt}
+
+def _embed_batch(queries: list[BatchQuery], store):
+    """
+    (Q, D) query matrix for a batch plus {query index: error} for the ones that failed.
+    `store` is the _snapshot() the batch is searched against.
+    """
+    index, _, id_rows, _ = store
+    qvecs = np.zeros((len(queries), index.d), dtype=np.float32)
+    errors = {}
+
+    texts = [(j, q.text) for j, q in enumerate(queries) if q.text]
+    for s in range(0, len(texts), 256):
+        chunk = texts[s:s + 256]
+        qvecs[[j for j, _ in chunk]] = embed_texts(
+            STATE["model"], STATE["tokenizer"], [t for _, t in chunk],
+            device=STATE["device"], cache=STATE["text_cache"], update_cache=False)
+
+    # indexed images: path -> images.id (DB) -> live row (sorted id lookup)
+    wanted = {}  # path -> every query index asking for it
+    for j, q in enumerate(queries):
+        if not q.text and q.path:
+            wanted.setdefault(q.path, []).append(j)
+    if wanted:
+        iids, paths = {}, list(wanted)
+        with _db() as con:
+            for s in range(0, len(paths), 500):  # stay under SQLite's bound-variable limit
+                chunk = paths[s:s + 500]
+                q = f"SELECT path, id FROM images WHERE path IN ({','.join('?' * len(chunk))})"
+                iids.update(con.execute(q, chunk))
+        rows = {}  # path -> live row
+        for p, r in zip(iids, rows_of(id_rows, list(iids.values()))):
+            if r >= 0:
+                rows[p] = int(r)
+        for p, js in wanted.items():
+            if p not in rows:
+                errors.update((j, f"Not indexed: {p}") for j in js)
+        if rows:
+            vecs = index.reconstruct(list(rows.values()))
+            for p, v in zip(rows, vecs):
+                qvecs[wanted[p]] = v
+
+    images = [(j, q.image_b64) for j, q in enumerate(queries) if not q.text and not q.path and q.image_b64]
+    cap = int(STATE["compute_cfg"]["max_upload_mb"] * (1 << 20))
+    for s in range(0, len(images), 64):
+        ok, tensors = [], []
+        for j, b64 in images[s:s + 64]:
+            if len(b64) * 3 // 4 > cap:
+                errors[j] = f"Image is over {STATE['compute_cfg']['max_upload_mb']} MB"
+                continue
+            try:
+                _, im = load_rgb(io.BytesIO(base64.b64decode(b64)), min_side=EMBED_SIDE,
+                                 max_pixels=STATE["compute_cfg"]["max_pixels"])
+                tensors.append(STATE["preprocess"](im)); ok.append(j)
+            except Exception as e:
+                errors[j] = f"Bad image: {e}"
+        if tensors:
+            qvecs[ok] = embed_images(STATE["model"], tensors, device=STATE["device"])
+
+    for j, q in enumerate(queries):
+        if not (q.text or q.path or q.image_b64):
+            errors[j] = "Empty query"
+    return qvecs, errors
+
+@app.post("/search_batch")
+def search_batch(body: SearchBatchBody):
+    """Many text/image queries in one call: one embedding pass per kind, one shared index scan."""
+    _require_index()
+    if len(body.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(400, f"At most {MAX_BATCH_QUERIES} queries per batch.")
+    return _compute(_search_batch, body)
+
+def _search_batch(body: SearchBatchBody):
+    store = _snapshot()
+    index, ids, _, attrs = store
+    qvecs, errors = _embed_batch(body.queries, store)
+    ok = [j for j in range(len(body.queries)) if j not in errors]
+    hits = {}
+    if ok:
+        D, I = index.search(qvecs[ok], body.topk, mask=_filter_mask(body.filters, attrs))
+        for j, d_row, i_row in zip(ok, D, I):
+            hits[j] = [(int(ids[i]), float(d)) for i, d in zip(i_row, d_row) if i != -1]
+    results = []
+    for j in range(len(body.queries)):
+        if j in errors:
+            results.append({"error": errors[j], "items": []})
+        else:
+            results.append({"items": _result_items(hits[j])})
+    return {"results": results}
 
 def _is_indexed_path(p: str) -> bool:
-    if STATE["con"] is None: return False
-    cur = STATE["con"].cursor()
-    return cur.execute("SELECT 1 FROM images WHERE path=? LIMIT 1", (p,)).fetchone() is not None
+    with _db() as con:
+        if con is None: return False
+        return con.execute("SELECT 1 FROM images WHERE path=? LIMIT 1", (p,)).fetchone() is not None
+
+def _thumb_lookup_many(paths=(), ids=()):
+    """
+    {("path", p) or ("id", images.id): (path, source mtime, {(size, fmt): (shard, offset, length)})}
+    for the indexed ones, a query per 500 keys.
+    """
+    out = {}
+    with _db() as con:
+        if con is None: return out
+        for col, keys in (("path", list(paths)), ("id", list(ids))):
+            for s in range(0, len(keys), 500):  # stay under SQLite's bound-variable limit
+                chunk = keys[s:s + 500]
+                q = f"""SELECT i.{col}, i.path, i.mtime, t.size, t.fmt, t.shard, t.offset, t.length FROM images i
+                        LEFT JOIN thumbs t ON t.path = i.path WHERE i.{col} IN ({','.join('?' * len(chunk))})"""
+                for key, path, mtime, *v in con.execute(q, chunk):
+                    hit = out.setdefault((col, key), (path, mtime or 0, {}))
+                    if v[2] is not None:
+                        hit[2][(v[0], v[1])] = tuple(v[2:])
+    return out
+
+def _thumb_pool():
+    if STATE["thumb_pool"] is None:
+        STATE["thumb_pool"] = ThreadPoolExecutor(max(1, int(STATE["thumbs"]["workers"])), thread_name_prefix="thumb")
+    return STATE["thumb_pool"]
+
+def _frame(header: dict, data: bytes = b"") -> bytes:
+    h = json.dumps(header).encode("utf-8")
+    return struct.pack(">I", len(h)) + h + struct.pack(">I", len(data)) + data
+
+@app.post("/thumbs")
+def thumbs(request: Request, body: ThumbsBody):
+    """
+    Many thumbnails in one length-prefixed binary stream, in request order (paths, then ids).
+    Each frame: u32 header length, JSON header {"i", "path", "id", "type", "etag"} (or with
+    "error"), u32 body length, body. Missing ones are made in parallel on the thumbnail pool.
+    """
+    keys = [("path", p) for p in body.paths] + [("id", int(i)) for i in body.ids]
+    if len(keys) > MAX_BATCH_THUMBS:
+        raise HTTPException(400, f"At most {MAX_BATCH_THUMBS} thumbnails per batch.")
+    tcfg = STATE["thumbs"]
+    size = size_bucket(tcfg, body.size)
+    fmt = body.format if body.format in FORMATS else pick_format(tcfg, request.headers.get("accept"))
+    found = _thumb_lookup_many(body.paths, body.ids)
+
+    # misses start on the pool right away; cached ones are read as the stream reaches them
+    jobs = []
+    for key in keys:
+        hit = found.get(key)
+        job = None
+        if hit is not None and (size, fmt) not in hit[2]:
+            job = _thumb_pool().submit(ensure_thumb, hit[0], size, fmt, hit[2])
+        jobs.append((key, hit, job))
+
+    def gen():
+        pack = open_pack(THUMB_DIR)
+        for i, (key, hit, job) in enumerate(jobs):
+            if hit is None:
+                yield _frame({"i": i, key[0]: key[1], "error": f"Unknown {key[0]}"})
+                continue
+            path, mtime, variants = hit
+            head = {"i": i, "path": path, "id": key[1] if key[0] == "id" else None}
+            data = job.result() if job is not None else pack.read(*variants[(size, fmt)])
+            if data is None and job is None:
+                data = ensure_thumb(path, size, fmt, variants)  # its shard went away
+            if not data:
+                yield _frame({**head, "error": "No thumbnail"})
+                continue
+            yield _frame({**head, "type": MIME[fmt], "etag": thumb_etag(path, mtime, size, fmt, tcfg)}, data)
+    return StreamingResponse(gen(), media_type="application/octet-stream")
 
 @app.get("/thumb")
-def thumb(path: str):
-    if not _is_indexed_path(path): raise HTTPException(404, "Unknown path")
-    
-    t = ensure_thumb(path)
-    if not t: raise HTTPException(404, "No thumbnail")
-    return FileResponse(t, media_type="image/jpeg")
+def thumb(request: Request, path: Optional[str] = None, id: Optional[int] = None, size: Optional[int] = None):
+    """By path or images.id; `size` snaps up to a configured bucket; WebP/AVIF when the Accept header allows."""
+    if path is None and id is None: raise HTTPException(400, "path or id required")
+    hit = _thumb_lookup_many(ids=[id]).get(("id", id)) if path is None else _thumb_lookup_many([path]).get(("path", path))
+    if hit is None: raise HTTPException(404, "Unknown path")
+    path, mtime, variants = hit
+    tcfg = STATE["thumbs"]
+    size = size_bucket(tcfg, size)
+    fmt = pick_format(tcfg, request.headers.get("accept"))
+    etag = thumb_etag(path, mtime, size, fmt, tcfg)
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={int(tcfg['max_age'])}", "Vary": "Accept"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    # one positioned read out of the pack
+    loc = variants.get((size, fmt))
+    data = open_pack(THUMB_DIR).read(*loc) if loc else None
+    if data is None:
+        data = _compute(ensure_thumb, path, size, fmt, variants)
+    if not data: raise HTTPException(404, "No thumbnail")
+    return Response(data, media_type=MIME[fmt], headers=headers)
 
 @app.get("/folders")
-def folders():
-    if STATE["con"] is None:
+def folders(request: Request, depth: int = 1):
+    """Image counts per root and folder, `depth` levels deep; from memory, revalidated by ETag."""
+    with STATE["swap_lock"]:  # the tree is swapped with the index, so its generation identifies it
+        tree, gen = STATE["folders"], STATE["generation"]
+    if tree is None:
         return {"total_images": 0, "roots": []}
-
-    cur = STATE["con"].cursor()
-    total = cur.execute("SELECT COUNT(*) FROM images").fetchone()[0]
-    by_root = cur.execute("""
-        SELECT root, COUNT(*) as n
-        FROM images GROUP BY root ORDER BY n DESC
-    """).fetchall()
-    by_root_top = cur.execute("""
-        SELECT root, top_folder, COUNT(*) as n
-        FROM images GROUP BY root, top_folder
-        ORDER BY root ASC, n DESC
-    """).fetchall()
-
-    children = {}
-    for r, f, n in by_root_top:
-        name = (f or "") or "(root)"
-        children.setdefault(r or "", []).append({"name": name, "count": n})
- 
-    roots = [{"root": r or "", "count": n, "folders": children.get(r or "", [])}
-             for r, n in by_root]
-
-    return {"total_images": total, "roots": roots}
+    etag = f'"{_BOOT}-{gen}-{max(1, depth)}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(tree.response(depth), headers=headers)
 
 @app.post("/open_path")
 def open_path(body: dict):
@@ -330,8 +760,48 @@ STATE["reindex"] = {
     "cancellable": False,     # explicit, no guessing in the client
     "started_at": None,       # unix seconds
     "ended_at": None,         # unix seconds (when terminal)
+    "scan": None,             # {new, changed, deleted, unchanged} once the scan has been diffed
 }
 
+def _compact_in_background():
+    """Merge vector segments / drop tombstones off the request path, then hot-swap."""
+    def worker():
+        from core.commands.indexer import compact_store
+        try:
+            if compact_store(STORE_DIR):
+                _reload_store_from_disk()
+        except Exception:
+            pass  # the segmented store stays valid; the next build retries
+
+    from core.commands.indexer import needs_compaction
+    if needs_compaction(STORE_DIR):
+        threading.Thread(target=worker, daemon=True).start()
+
+def _watch_update(paths) -> bool:
+    """Watcher callback: index just the changed paths and hot-swap the result."""
+    if STATE["reindex"]["running"]:
+        return False  # a full job is rewriting the store; retry after it
+    from core.commands.indexer import update_paths
+    stats = update_paths(paths, _current_roots(), STORE_DIR, STATE["model"], STATE["preprocess"],
+                         device=STATE["device"])
+    if (stats["embedded"] or stats["deleted"]) and STATE["watcher"] is not None:
+        _swap_store(load_store())
+        _compact_in_background()
+    return True
+
+def _stop_watcher():
+    w, STATE["watcher"] = STATE["watcher"], None
+    if w is not None:
+        w.stop()
+
+def _restart_watcher():
+    """(Re)start watching the roots in config.json, e.g. after they changed."""
+    _stop_watcher()
+    cfg = _store_cfg()
+    roots = _current_roots()
+    if roots and watch_cfg(cfg)["enabled"]:
+        STATE["watcher"] = Watcher(roots, _watch_update, cfg, ignore=(STORE_DIR,)).start()
+
 def _reindex_worker(roots: list[str]):
     try:
         job_id = uuid.uuid4().hex
@@ -347,6 +817,7 @@ def _reindex_worker(roots: list[str]):
             "cancellable": True,          # allow cancel during scanning/embedding
             "started_at": time.time(),
             "ended_at": None,
+            "scan": None,
         })
         STATE["cancel_event"].clear()
 
@@ -362,22 +833,18 @@ def _reindex_worker(roots: list[str]):
             roots, STORE_DIR, STATE["model"], STATE["preprocess"],
             progress_cb=on_progress,
             device=STATE["device"],
-            stop_event=STATE["cancel_event"]
+            stop_event=STATE["cancel_event"],
+            scan_cb=lambda counts: STATE["reindex"].update({"scan": counts}),
         )
 
         # finalizing: lock out cancel
         STATE["reindex"].update({"phase": "finalizing", "state": "finalizing", "cancellable": False})
 
         # hot-swap
-        idx_new, ids_new, con_new = load_store()
-        with STATE["swap_lock"]:
-            idx_old, ids_old, con_old = STATE["index"], STATE["ids"], STATE["con"]
-            STATE["index"], STATE["ids"], STATE["con"] = idx_new, ids_new, con_new
-            STATE["dim"] = idx_new.d
-        try:
-            if con_old: con_old.close()
-        except Exception:
-            pass
+        _swap_store(load_store())
+        _compact_in_background()
+        _restart_watcher()  # roots may have changed
+        _start_thumb_backfill()
 
         STATE["reindex"].update({
             "phase": "done",
@@ -481,6 +948,14 @@ def cancel_index(body: CancelBody):
     STATE["cancel_event"].set()
     return {"status": "cancel requested", "job_id": r.get("job_id")}
 
+def _store_cfg() -> dict:
+    """config.json as a dict ({} if missing/unreadable)."""
+    try:
+        with open(os.path.join(STORE_DIR, "config.json")) as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
 # get all the current roots
 def _current_roots() -> list[str]:
     cfg_path = os.path.join(STORE_DIR, "config.json")
@@ -517,14 +992,10 @@ def remove_roots(body: RemoveRootsBody):
 
     # If nothing left: wipe EVERYTHING and reset in-memory state
     if not survivors:
+        _stop_watcher()
+        _stop_thumb_backfill()
         # delete index files and config
-        for name in ("index.faiss", "vectors.npy", "ids.npy", "config.json"):
-            p = os.path.join(STORE_DIR, name)
-            try:
-                if os.path.exists(p):
-                    os.remove(p)
-            except Exception:
-                pass
+        wipe_store_files(STORE_DIR)
 
         # clear the DB so /folders is empty immediately
         db_path = os.path.join(STORE_DIR, "meta.sqlite")
@@ -533,22 +1004,17 @@ def remove_roots(body: RemoveRootsBody):
                 with sqlite3.connect(db_path, check_same_thread=False, timeout=5.0) as con:
                     con.execute("PRAGMA busy_timeout=5000;")
                     con.execute("DELETE FROM images")
+                    if con.execute("SELECT 1 FROM sqlite_master WHERE name='thumbs'").fetchone():
+                        con.execute("DELETE FROM thumbs")
                     con.commit()
         except Exception:
             pass
+        close_pack(THUMB_DIR)
+        shutil.rmtree(THUMB_DIR, ignore_errors=True)
+        os.makedirs(THUMB_DIR, exist_ok=True)
 
         # reset server state
-        try:
-            if STATE.get("con"):
-                STATE["con"].close()
-        except Exception:
-            pass
-        STATE.update({
-            "index": None,
-            "ids": None,
-            "con": None,
-            "dim": 0
-        })
+        _swap_store(dict(_EMPTY_STORE))
 
         # if you track numpy fallback state elsewhere, reset it too:
         # STATE["mode"] = None
@@ -556,75 +1022,19 @@ def remove_roots(body: RemoveRootsBody):
 
         return {"state": "done", "removed": list(to_remove), "roots": []}
 
-    # Rebuild the index with survivors ONLY (no merge!)
-    def worker():
-        try:
-            job_id = uuid.uuid4().hex
-            STATE["reindex"].update({
-                "state": "running",
-                "phase": "scanning",
-                "running": True,
-                "processed": 0,
-                "total": 0,
-                "error": None,
-                "cancelled": False,
-                "job_id": job_id,
-                "cancellable": False,        # ← explicit: FE won’t offer cancel
-                "started_at": time.time(),
-                "ended_at": None,
-            })
-            STATE["cancel_event"].clear()
-
-            from core.commands.indexer import build_index_with_progress, CancelledError
-
-            def on_progress(done, total):
-                if STATE["reindex"].get("phase") == "scanning":
-                    STATE["reindex"]["phase"] = "embedding"
-                STATE["reindex"].update({"processed": done, "total": total})
-
-            build_index_with_progress(
-                roots=survivors,
-                store_dir=STORE_DIR,
-                model=STATE["model"],
-                preprocess=STATE["preprocess"],
-                progress_cb=on_progress,
-                device=STATE["device"],
-                stop_event=STATE["cancel_event"],
-            )
-
-            STATE["reindex"].update({"phase": "finalizing", "state": "finalizing"})
-
-            idx, ids, con = load_store()
-            with STATE["swap_lock"]:
-                idx_old, ids_old, con_old = STATE["index"], STATE["ids"], STATE["con"]
-                STATE["index"], STATE["ids"], STATE["con"] = idx, ids, con
-                STATE["dim"] = idx.d
-            try:
-                if con_old: con_old.close()
-            except Exception:
-                pass
-
-            STATE["reindex"].update({"phase": "done", "state": "done", "ended_at": time.time()})
-
-        except CancelledError:
-            STATE["reindex"].update({
-                "error": None, "cancelled": True, "phase": "cancelled",
-                "state": "cancelled", "ended_at": time.time()
-            })
-            _reload_store_from_disk()   # ← ensure STATE mirrors disk after cancel
-
-        except Exception as e:
-            STATE["reindex"].update({
-                "error": str(e), "phase": "error", "state": "error",
-                "ended_at": time.time()
-            })
-            _reload_store_from_disk()   # ← ensure STATE mirrors disk after error
-
-        finally:
-            STATE["reindex"]["running"] = False
-
-    threading.Thread(target=worker, daemon=True).start()
-    return {"state": "started", "removed": list(to_remove), "roots": survivors}
+    # Survivors are untouched: drop the removed roots' rows and tombstone their vectors
+    # instead of rebuilding (no rescan, no re-embed)
+    from core.commands.indexer import drop_roots
+    _stop_watcher()
+    _stop_thumb_backfill()
+    try:
+        deleted = drop_roots(sorted(to_remove), survivors, STORE_DIR)
+    finally:
+        _reload_store_from_disk()
+        _restart_watcher()
+    _compact_in_background()
+    _start_thumb_backfill()  # its GC pass reclaims the dropped thumbnails
+    return {"state": "done", "removed": list(to_remove), "roots": survivors, "deleted": deleted}
 
 class NukeAllBody(BaseModel):
     confirm: Optional[str] = None  # optional extra guard
@@ -636,20 +1046,12 @@ def nuke_all(body: NukeAllBody):
     # optional guard: require confirm === "NUKE"
     if body.confirm is not None and body.confirm != "NUKE":
         raise HTTPException(400, "Confirmation failed. Send {\"confirm\":\"NUKE\"} to proceed.")
+    _stop_watcher()
+    _stop_thumb_backfill()
     _wipe_store()
 
-        # reset in-memory state
-    try:
-        if STATE.get("con"):
-            STATE["con"].close()
-    except Exception:
-        pass
-    STATE.update({
-        "index": None,
-        "ids": None,
-        "con": None,
-        "dim": 0
-    })
+    # reset in-memory state
+    _swap_store(dict(_EMPTY_STORE))
     # if you track numpy fallback:
     # STATE["mode"] = None
     # STATE["X"] = None
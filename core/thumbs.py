@@ -0,0 +1,367 @@
+# thumbs.py
+# Gallery thumbnails, packed back to back into append-only shard files under
+# STORE_DIR/thumbs. The `thumbs` table in meta.sqlite maps path -> (shard, offset,
+# length), so serving one is a single lookup and a positioned read. Newly indexed
+# images get theirs from the decode the embedder already does; anything older is
+# filled in by a background backfill, which also garbage-collects shards.
+# Other size buckets and formats (WebP/AVIF for clients that accept them) are made on
+# first request from the largest cached variant, and packed alongside.
+import os, io, hashlib, sqlite3, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, features
+
+from core.helpers.images import load_rgb
+
+# defaults for the "thumbs" block in config.json
+DEFAULT_THUMB_CFG = {
+    "size": 512,            # longest side, px, of the pregenerated variant
+    "sizes": [128, 256, 512, 1024],  # buckets /thumb?size= snaps up to
+    "formats": ["webp", "jpeg"],     # served by preference when Accept allows (jpeg always works)
+    "max_age": 3600,        # Cache-Control max-age; revalidated by ETag after that
+    "pregenerate": True,    # write thumbnails while indexing and backfill missing ones
+    "profile": "fast",      # fast|best encoder settings (see PROFILES)
+    "quality": 0,           # 0 = the profile's default
+    "backfill_threads": 2,
+    "workers": 4,           # threads making missing thumbnails for /thumbs batches
+    "shard_mb": 256,        # a shard is closed and a new one started past this size
+    "gc_min_live": 0.5,     # shards with less live data than this fraction get rewritten
+}
+
+# encoder settings per profile and format; "best" jpeg is what /thumb used to do inline
+PROFILES = {
+    "fast": {
+        "jpeg": {"quality": 85},
+        "webp": {"quality": 80, "method": 2},
+        "avif": {"quality": 60, "speed": 8},
+    },
+    "best": {
+        "jpeg": {"quality": 95, "optimize": True, "progressive": True},
+        "webp": {"quality": 90, "method": 5},
+        "avif": {"quality": 75, "speed": 5},
+    },
+}
+MIME = {"jpeg": "image/jpeg", "webp": "image/webp", "avif": "image/avif"}
+
+def _encodable(fmt):
+    if fmt == "jpeg":
+        return True
+    try:
+        return bool(features.check(fmt))
+    except Exception:
+        return False
+
+# formats this Pillow build can write
+FORMATS = [f for f in MIME if _encodable(f)]
+
+SHARD_EXT = ".pack"
+# shards written to this recently may have rows that aren't committed yet; GC leaves them
+GC_GRACE_SECONDS = 60.0
+
+def thumb_cfg(cfg):
+    out = dict(DEFAULT_THUMB_CFG)
+    out.update((cfg or {}).get("thumbs") or {})
+    return out
+
+_CREATE = """CREATE TABLE IF NOT EXISTS thumbs(
+    path TEXT,                  -- images.path
+    size INT,                   -- bucket (longest side, px)
+    fmt TEXT,                   -- jpeg|webp|avif
+    shard TEXT,                 -- <shard>.pack under STORE_DIR/thumbs
+    offset INT,
+    length INT,
+    PRIMARY KEY(path, size, fmt)
+);"""
+
+def ensure_thumb_table(con):
+    cols = {r[1] for r in con.execute("PRAGMA table_info(thumbs)")}
+    if cols and "shard" not in cols:
+        # one-file-per-thumbnail layout; the backfill repacks them
+        con.execute("DROP TABLE thumbs;")
+    elif cols and "fmt" not in cols:
+        # single-variant pack rows: those were default-size JPEGs
+        con.execute("ALTER TABLE thumbs RENAME TO thumbs_old;")
+        con.execute(_CREATE)
+        con.execute("INSERT INTO thumbs SELECT path, ?, 'jpeg', shard, offset, length FROM thumbs_old",
+                    (DEFAULT_THUMB_CFG["size"],))
+        con.execute("DROP TABLE thumbs_old;")
+        con.commit()
+    con.execute(_CREATE)
+
+def size_bucket(tcfg, size=None):
+    """Smallest configured bucket >= `size` (the pregenerated size when not given)."""
+    if not size:
+        return int(tcfg["size"])
+    buckets = sorted({int(b) for b in tcfg["sizes"]} | {int(tcfg["size"])})
+    return next((b for b in buckets if b >= int(size)), buckets[-1])
+
+def pick_format(tcfg, accept=None):
+    """First configured format the client accepts and we can encode; jpeg otherwise."""
+    accept = (accept or "").lower()
+    for fmt in tcfg["formats"]:
+        if fmt in FORMATS and (fmt == "jpeg" or MIME[fmt] in accept):
+            return fmt
+    return "jpeg"
+
+def pregen_format(tcfg):
+    """Format of the variant made while indexing: the preferred one."""
+    return next((f for f in tcfg["formats"] if f in FORMATS), "jpeg")
+
+def thumb_etag(path, mtime, size, fmt, tcfg):
+    """Strong validator: changes with the source file, the variant and the encoder settings."""
+    h = hashlib.md5(f"{path}|{mtime}|{size}|{fmt}|{tcfg['profile']}|{tcfg['quality']}".encode("utf-8"))
+    return f'"{h.hexdigest()}"'
+
+def _save_opts(tcfg, fmt):
+    opts = dict(PROFILES.get(tcfg["profile"], PROFILES["fast"])[fmt])
+    if tcfg["quality"]:
+        opts["quality"] = int(tcfg["quality"])
+    return opts
+
+def _encode(im, size, fmt, tcfg):
+    if max(im.size) > size:
+        im = im.copy()
+        im.thumbnail((size, size), Image.LANCZOS)
+    buf = io.BytesIO()
+    im.save(buf, fmt.upper(), **_save_opts(tcfg, fmt))
+    return buf.getvalue()
+
+def encode_thumb(path, tcfg, im=None, size=None, fmt=None):
+    """
+    Encoded thumbnail of `path` (default: the pregenerated size and format).
+    `im` is an already decoded copy (RGB, EXIF-rotated).
+    """
+    size = int(size or tcfg["size"])
+    if im is None:
+        # draft-decode near the target size, honour EXIF, flatten alpha over white
+        _, im = load_rgb(path, min_side=size, exif=True, flatten_alpha=True)
+    return _encode(im, size, fmt or pregen_format(tcfg), tcfg)
+
+def derive_thumb(data, size, fmt, tcfg):
+    """Another size/format from an already encoded, at least as large thumbnail."""
+    with Image.open(io.BytesIO(data)) as im:
+        if im.format == "JPEG":
+            im.draft("RGB", (size, size))
+        im = im.convert("RGB")
+    return _encode(im, size, fmt, tcfg)
+
+class ThumbPack:
+    """
+    Append-only shard files of encoded thumbnails. A process only ever appends to
+    shards it created itself, so writers (server, a CLI build) never share a file.
+    """
+    def __init__(self, thumb_dir, shard_bytes=256 << 20):
+        self.dir = thumb_dir
+        self.shard_bytes = int(shard_bytes)
+        self.active = None    # name of the shard this process appends to
+        self._f = None
+        self._fds = {}        # shard name -> [read-only fd, readers using it, dropped]
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.dir, name + SHARD_EXT)
+
+    def put(self, data):
+        """Append one thumbnail -> (shard, offset, length)."""
+        with self._lock:
+            if self._f is None or self._f.tell() + len(data) > self.shard_bytes:
+                self._roll()
+            off = self._f.tell()
+            self._f.write(data)
+            self._f.flush()  # visible to readers before its row is committed
+            return self.active, off, len(data)
+
+    def _roll(self):
+        if self._f is not None:
+            self._f.close()
+        os.makedirs(self.dir, exist_ok=True)
+        self.active = f"{int(time.time()):x}-{uuid.uuid4().hex[:8]}"
+        self._f = open(self._path(self.active), "ab")
+
+    def _acquire(self, name):
+        """Check out the shard's fd entry; remove()/close() only close it once every reader is done."""
+        with self._lock:
+            ent = self._fds.get(name)
+            if ent is not None:
+                ent[1] += 1
+                return ent
+        try:
+            fd = os.open(self._path(name), os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        except OSError:
+            return None
+        with self._lock:
+            ent = self._fds.get(name)
+            if ent is None:
+                ent = self._fds[name] = [fd, 0, False]
+            else:
+                os.close(fd)
+            ent[1] += 1
+            return ent
+
+    def _release(self, ent):
+        with self._lock:
+            ent[1] -= 1
+            if ent[1] == 0 and ent[2]:
+                os.close(ent[0])  # dropped by remove()/close() while we were reading
+
+    def _drop(self, name):
+        # caller holds self._lock; readers still using the fd close it in _release()
+        ent = self._fds.pop(name, None)
+        if ent is not None:
+            ent[2] = True
+            if ent[1] == 0:
+                os.close(ent[0])
+
+    def read(self, name, offset, length):
+        """The stored bytes, or None if the shard is gone/short."""
+        ent = self._acquire(name)
+        if ent is None:
+            return None
+        try:
+            fd = ent[0]
+            if hasattr(os, "pread"):
+                data = os.pread(fd, length, offset)
+            else:  # Windows: no positioned read, serialize seek+read
+                with self._lock:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    data = os.read(fd, length)
+        except OSError:
+            return None
+        finally:
+            self._release(ent)
+        return data if len(data) == length else None
+
+    def shards(self):
+        """{shard name: (bytes on disk, mtime)}"""
+        out = {}
+        try:
+            entries = list(os.scandir(self.dir))
+        except OSError:
+            return out
+        for e in entries:
+            if e.name.endswith(SHARD_EXT):
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                out[e.name[:-len(SHARD_EXT)]] = (st.st_size, st.st_mtime)
+        return out
+
+    def remove(self, name):
+        with self._lock:
+            self._drop(name)
+        try:
+            os.remove(self._path(name))
+        except OSError:
+            pass
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+            self._f, self.active = None, None
+            for name in list(self._fds):
+                self._drop(name)
+
+# one pack per thumbnail dir per process, shared by the server and in-process builds
+_PACKS = {}
+_PACKS_LOCK = threading.Lock()
+
+def open_pack(thumb_dir, tcfg=None):
+    key = os.path.abspath(thumb_dir)
+    with _PACKS_LOCK:
+        pack = _PACKS.get(key)
+        if pack is None:
+            pack = _PACKS[key] = ThumbPack(key, int(thumb_cfg(None)["shard_mb"]) << 20)
+        if tcfg is not None:
+            pack.shard_bytes = int(tcfg["shard_mb"]) << 20
+        return pack
+
+def close_pack(thumb_dir):
+    """Before wiping the directory: forget open shards so the next write starts a fresh one."""
+    with _PACKS_LOCK:
+        pack = _PACKS.pop(os.path.abspath(thumb_dir), None)
+    if pack is not None:
+        pack.close()
+
+def record_thumbs(con, rows):
+    """(path, size, fmt, shard, offset, length) rows; a replaced entry's bytes are left for GC."""
+    if rows:
+        con.executemany("""INSERT OR REPLACE INTO thumbs(path, size, fmt, shard, offset, length)
+                           VALUES(?,?,?,?,?,?)""", rows)
+
+def drop_thumbs(con, paths):
+    """Forget every variant of these images, e.g. they left the index or changed (bytes are left for GC)."""
+    con.executemany("DELETE FROM thumbs WHERE path=?", [(p,) for p in paths])
+
+def _try_encode(path, tcfg):
+    try:
+        return encode_thumb(path, tcfg)
+    except Exception:
+        return None
+
+def backfill_thumbs(db_path, thumb_dir, tcfg, stop_event=None):
+    """Generate thumbnails for indexed images that have none yet. Returns how many were made."""
+    pack = open_pack(thumb_dir, tcfg)
+    size, fmt = int(tcfg["size"]), pregen_format(tcfg)
+    con = sqlite3.connect(db_path, check_same_thread=False, timeout=5.0)
+    con.execute("PRAGMA busy_timeout=5000;")
+    made = 0
+    try:
+        ensure_thumb_table(con)
+        todo = [p for (p,) in con.execute("""SELECT i.path FROM images i
+                                             LEFT JOIN thumbs t ON t.path = i.path WHERE t.path IS NULL""")]
+        with ThreadPoolExecutor(max(1, int(tcfg["backfill_threads"]))) as pool:
+            for s in range(0, len(todo), 64):
+                if stop_event is not None and stop_event.is_set():
+                    break
+                chunk = todo[s:s + 64]
+                blobs = pool.map(lambda p: _try_encode(p, tcfg), chunk)
+                rows = [(p, size, fmt, *pack.put(b)) for p, b in zip(chunk, blobs) if b]
+                record_thumbs(con, rows)
+                con.commit()
+                made += len(rows)
+    finally:
+        con.close()
+    return made
+
+def gc_thumbs(db_path, thumb_dir, tcfg):
+    """
+    Drop rows of images no longer indexed, then copy the live entries out of shards
+    that are mostly garbage and delete them. Returns the number of shards removed.
+    """
+    pack = open_pack(thumb_dir, tcfg)
+    con = sqlite3.connect(db_path, check_same_thread=False, timeout=5.0)
+    con.execute("PRAGMA busy_timeout=5000;")
+    removed = 0
+    try:
+        ensure_thumb_table(con)
+        con.execute("DELETE FROM thumbs WHERE path NOT IN (SELECT path FROM images)")
+        con.commit()
+        live = dict(con.execute("SELECT shard, SUM(length) FROM thumbs GROUP BY shard"))
+        now = time.time()
+        for name, (size, mtime) in pack.shards().items():
+            if name == pack.active or now - mtime < GC_GRACE_SECONDS:
+                continue
+            if size and live.get(name, 0) >= float(tcfg["gc_min_live"]) * size:
+                continue
+            moved = []
+            rows = con.execute("SELECT path, size, fmt, offset, length FROM thumbs WHERE shard=?", (name,)).fetchall()
+            for p, sz, fmt, off, n in rows:
+                data = pack.read(name, off, n)
+                if data is not None:
+                    moved.append((p, sz, fmt, *pack.put(data)))
+            con.execute("DELETE FROM thumbs WHERE shard=?", (name,))  # unreadable leftovers get remade
+            record_thumbs(con, moved)
+            con.commit()
+            pack.remove(name)
+            removed += 1
+        # one-file-per-thumbnail leftovers from before the pack
+        for e in os.scandir(thumb_dir):
+            if e.name.endswith(".jpg"):
+                try:
+                    os.remove(e.path)
+                except OSError:
+                    pass
+    finally:
+        con.close()
+    return removed
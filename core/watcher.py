@@ -0,0 +1,264 @@
+# watcher.py
+# Keeps the index fresh between /reindex runs: filesystem events under the roots are
+# collected, debounced, and handed to the server in small batches.
+import os, sys, time, errno, select, struct, threading, ctypes, ctypes.util
+import logging
+
+from core.helpers.walk import DirWalker, _is_image
+
+logger = logging.getLogger("refsearch.indexer")  # same log file as indexing
+
+# defaults for the "watch" block in config.json
+DEFAULT_WATCH_CFG = {
+    "enabled": True,
+    "backend": "auto",      # auto|inotify|poll (auto = inotify on Linux, else poll)
+    "debounce": 2.0,        # seconds without new events before a batch is indexed...
+    "max_delay": 30.0,      # ...but never hold changes back longer than this
+    "max_batch": 256,       # paths per incremental update (each becomes one segment)
+    "poll_interval": 60.0,  # polling fallback: seconds between directory rescans
+}
+
+def watch_cfg(cfg):
+    out = dict(DEFAULT_WATCH_CFG)
+    out.update((cfg or {}).get("watch") or {})
+    return out
+
+# <sys/inotify.h>
+_IN_MODIFY      = 0x00000002
+_IN_ATTRIB      = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM  = 0x00000040
+_IN_MOVED_TO    = 0x00000080
+_IN_CREATE      = 0x00000100
+_IN_DELETE      = 0x00000200
+_IN_Q_OVERFLOW  = 0x00004000
+_IN_IGNORED     = 0x00008000
+_IN_ONLYDIR     = 0x01000000
+_IN_ISDIR       = 0x40000000
+_IN_NONBLOCK    = os.O_NONBLOCK
+_IN_CLOEXEC     = 0o2000000
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO
+               | _IN_CREATE | _IN_DELETE | _IN_ONLYDIR)
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len (name follows)
+
+class _Inotify:
+    """One inotify watch per directory under the roots (inotify is not recursive)."""
+    def __init__(self, roots):
+        self.roots = roots
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._wd = {}    # wd -> directory
+        self._dirs = {}  # directory -> wd
+        try:
+            for root in roots:
+                self._add_tree(root)
+        except Exception:
+            self.close()
+            raise
+
+    def _add_tree(self, top):
+        for dirpath, _, _ in os.walk(top):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dirpath), _WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    raise OSError(err, "inotify watch limit reached (fs.inotify.max_user_watches)")
+                continue  # vanished or unreadable; nothing to index there anyway
+            self._wd[wd] = dirpath
+            self._dirs[dirpath] = wd
+
+    def _drop_tree(self, top):
+        pre = top + os.sep
+        for d in [d for d in self._dirs if d == top or d.startswith(pre)]:
+            wd = self._dirs.pop(d)
+            self._wd.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """Changed files/directories seen within `timeout` seconds ([] when idle)."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        out, pos = [], 0
+        while pos + _EVENT.size <= len(buf):
+            wd, mask, _, n = _EVENT.unpack_from(buf, pos)
+            name = buf[pos + _EVENT.size:pos + _EVENT.size + n].rstrip(b"\0")
+            pos += _EVENT.size + n
+            if mask & _IN_Q_OVERFLOW:
+                out.extend(self.roots)  # events were dropped: rescan everything
+                continue
+            base = self._wd.get(wd)
+            if base is None:
+                continue
+            if mask & _IN_IGNORED:  # directory itself went away
+                self._wd.pop(wd, None)
+                if self._dirs.get(base) == wd:
+                    del self._dirs[base]
+                continue
+            if not name:
+                continue
+            path = os.path.join(base, os.fsdecode(name))
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self._add_tree(path)
+                elif mask & (_IN_MOVED_FROM | _IN_DELETE):
+                    self._drop_tree(path)
+                out.append(path)
+            elif _is_image(path):
+                out.append(path)
+        return out
+
+    def close(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+def _topmost(dirs):
+    """`dirs` minus those under another one of them (update_paths walks directories recursively)."""
+    dirs = set(dirs)
+    out = []
+    for d in dirs:
+        a, parent = d, os.path.dirname(d)
+        while parent != a and parent not in dirs:
+            a, parent = parent, os.path.dirname(parent)
+        if parent == a:  # reached the filesystem root
+            out.append(d)
+    return out
+
+class _Poller:
+    """
+    Fallback: every `interval` seconds, re-walk the roots with the previous walk's
+    directory cache. Directories whose mtime is unchanged are not listed and their
+    files are not stat'ed, so an idle poll costs one stat per directory; a listed
+    one (files added, removed or renamed in it) is reported for update_paths.
+    Files rewritten in place don't touch their directory's mtime: those wait for
+    the next /reindex.
+    """
+    def __init__(self, roots, interval, stop):
+        self.roots, self.interval, self._stop = roots, interval, stop
+        self._cache = self._walk()[0]
+        self._next = time.monotonic() + interval
+
+    def _walk(self, cache=None):
+        walker = DirWalker(self.roots, cache=cache)
+        for _ in walker:
+            pass
+        return walker.listing, walker
+
+    def read(self, timeout):
+        wait = self._next - time.monotonic()
+        if wait > 0:
+            self._stop.wait(min(wait, timeout))
+            return []
+        prev = self._cache
+        self._cache, walker = self._walk(prev)
+        out = _topmost(walker.listed)
+        # a root that vanished: update_paths drops what was indexed under it
+        out.extend(r for r in self.roots if r in prev and r not in walker.listed and r not in walker.trusted)
+        self._next = time.monotonic() + self.interval
+        return out
+
+    def close(self):
+        pass
+
+class Watcher:
+    """
+    Background thread turning filesystem changes under `roots` into debounced
+    on_change(paths) calls. on_change returning False means "busy, retry later".
+    """
+    def __init__(self, roots, on_change, cfg=None, ignore=()):
+        self.roots = list(roots)
+        self.on_change = on_change
+        self.cfg = watch_cfg(cfg)
+        self.backend = None
+        self._ignore = tuple(p.rstrip(os.sep) + os.sep for p in ignore)
+        self._dirty = {}  # ordered set of changed paths
+        self._first = self._last = 0.0
+        self._stats = {"updates": 0, "last_update": None, "error": None}
+        self._stop = threading.Event()
+        self._t = threading.Thread(target=self._run, daemon=True, name="refsearch-watch")
+
+    def start(self):
+        self._t.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._t.is_alive() and self._t is not threading.current_thread():
+            self._t.join(timeout)
+
+    def status(self):
+        return {"backend": self.backend, "roots": self.roots, "pending": len(self._dirty), **self._stats}
+
+    def _open(self):
+        kind = self.cfg["backend"]
+        if kind in ("auto", "inotify") and sys.platform.startswith("linux"):
+            try:
+                src = _Inotify(self.roots)
+                self.backend = "inotify"
+                return src
+            except Exception as e:
+                logger.warning("inotify unavailable (%s); polling every %ss", e, self.cfg["poll_interval"])
+        self.backend = "poll"
+        return _Poller(self.roots, float(self.cfg["poll_interval"]), self._stop)
+
+    def _run(self):
+        try:
+            src = self._open()  # adding watches walks the tree; keep it off the caller's thread
+        except Exception as e:
+            self._stats["error"] = str(e)
+            logger.exception("Watcher failed to start")
+            return
+        logger.info("Watching %d root(s) via %s", len(self.roots), self.backend)
+        try:
+            while not self._stop.is_set():
+                timeout = 1.0  # bounds how long stop() waits
+                if self._dirty:
+                    due = min(self._last + float(self.cfg["debounce"]),
+                              self._first + float(self.cfg["max_delay"]))
+                    now = time.monotonic()
+                    if now >= due:
+                        self._flush()
+                        continue
+                    timeout = min(timeout, due - now)
+                for p in src.read(timeout):
+                    self._mark(p)
+        except Exception as e:
+            self._stats["error"] = str(e)
+            logger.exception("Watcher stopped")
+        finally:
+            src.close()
+
+    def _mark(self, path):
+        if self._ignore and (path + os.sep).startswith(self._ignore):
+            return
+        now = time.monotonic()
+        if not self._dirty:
+            self._first = now
+        self._last = now
+        self._dirty[path] = None
+
+    def _flush(self):
+        batch = list(self._dirty)[:max(1, int(self.cfg["max_batch"]))]
+        error = None
+        try:
+            ok = self.on_change(batch)
+        except Exception as e:
+            # drop them; the next /reindex (or event) picks these files up again
+            ok, error = True, str(e)
+            logger.exception("Watch update failed for %d path(s)", len(batch))
+        if ok is False:
+            self._first = self._last = time.monotonic()  # busy: back off one debounce period
+            return
+        for p in batch:
+            self._dirty.pop(p, None)
+        self._stats["updates"] += 1
+        self._stats["last_update"] = time.time()
+        self._stats["error"] = error
@@ -1,7 +1,11 @@
 import os
+import multiprocessing
 import uvicorn
 from core.server import app, PORT 
 
-host = os.environ.get("REFSEARCH_HOST", "127.0.0.1")
-port = int(os.environ.get("REFSEARCH_PORT", str(PORT)))
-uvicorn.run(app, host=host, port=port, log_level="warning", access_log=False)
\ No newline at end of file
+if __name__ == "__main__":
+    # the indexer's decode pool spawns workers; frozen builds must not re-run the server in them
+    multiprocessing.freeze_support()
+    host = os.environ.get("REFSEARCH_HOST", "127.0.0.1")
+    port = int(os.environ.get("REFSEARCH_PORT", str(PORT)))
+    uvicorn.run(app, host=host, port=port, log_level="warning", access_log=False)
@@ -0,0 +1,45 @@
+# Per-image decode cost: full-resolution decode vs core.helpers.images.load_rgb
+#   python -m scripts.bench_decode ~/Pictures/refs --limit 200 --side 224
+import argparse, os, time
+from PIL import Image
+
+from core.commands.indexer import _collect_paths
+from core.helpers.images import load_rgb
+
+def _full(path, side):
+    # what the indexer/thumbnailer used to do: decode everything, then shrink
+    with Image.open(path) as im:
+        im = im.convert("RGB")
+    im.thumbnail((side * 4, side * 4))  # stand-in for the preprocess/thumbnail resize
+    return im
+
+def _reduced(path, side):
+    _, im = load_rgb(path, min_side=side)
+    im.thumbnail((side * 4, side * 4))
+    return im
+
+def _bench(fn, paths, side):
+    t0 = time.perf_counter()
+    for p in paths:
+        fn(p, side)
+    return (time.perf_counter() - t0) * 1000 / max(len(paths), 1)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("folder")
+    ap.add_argument("--limit", type=int, default=100)
+    ap.add_argument("--side", type=int, default=224, help="224 = embedding, 512 = thumbnail")
+    args = ap.parse_args()
+
+    paths = [p for _, p in _collect_paths([os.path.abspath(args.folder)])][:args.limit]
+    if not paths:
+        raise SystemExit("No images found")
+    _bench(_reduced, paths[:3], args.side)  # warm the page cache
+    before = _bench(_full, paths, args.side)
+    after = _bench(_reduced, paths, args.side)
+    print(f"{len(paths)} images, side={args.side}")
+    print(f"  full decode    : {before:8.1f} ms/image")
+    print(f"  reduced decode : {after:8.1f} ms/image  ({before / max(after, 1e-9):.1f}x)")
+
+if __name__ == "__main__":
+    main()